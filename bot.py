@@ -1,5 +1,6 @@
 import json
 import logging
+import math
 import random
 import asyncio
 import time
@@ -7,8 +8,35 @@ import os
 import threading
 import atexit
 import signal
+from collections import Counter, OrderedDict
+from collections.abc import Mapping
+from contextlib import asynccontextmanager
+from functools import lru_cache, partial, wraps
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import h2  # noqa: F401  (HTTP/2 для httpx, пакет httpx[http2])
+    HTTP_VERSION = "2"
+except ImportError:
+    HTTP_VERSION = "1.1"
+try:
+    import aiolimiter  # noqa: F401  (нужен AIORateLimiter, пакет python-telegram-bot[rate-limiter])
+    HAS_RATE_LIMITER = True
+except ImportError:
+    HAS_RATE_LIMITER = False
+try:
+    import uvloop  # цикл событий на libuv; под Windows не ставится
+except ImportError:
+    uvloop = None
 from telegram import Update, ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove
-from telegram.ext import Application, CommandHandler, MessageHandler, ContextTypes, filters
+from telegram.error import BadRequest
+from telegram.helpers import escape_markdown
+from telegram.ext import AIORateLimiter, Application, CommandHandler, MessageHandler, ContextTypes, filters
+from telegram.request import HTTPXRequest
 
 # Получаем путь к директории скрипта
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -40,11 +68,32 @@ print("✅ Токен успешно загружен")
 
 # --- ИМПОРТ БАЗЫ ДАННЫХ ---
 from database import db
+import db_async
 
 # --- ГЛОБАЛЬНЫЕ ПЕРЕМЕННЫЕ ---
-PLAYER_CACHE = {}
-SAVE_LOCK = threading.Lock()
+PLAYER_CACHE = OrderedDict()  # LRU: последние активные игроки в конце
+MAX_CACHED_PLAYERS = 5000
+SAVE_LOCK = threading.Lock()  # только на снимок PLAYER_CACHE; сами игроки защищены Player._save_lock
 AUTO_SAVE_INTERVAL = 300  # 5 минут
+AUTO_SAVE_INTERVAL_SHORT = 10  # сброс "грязных" игроков в БД
+# Если с той же БД работают несколько процессов, кэш игроков периодически перечитывается
+MULTI_PROCESS = os.environ.get("BOT_MULTI_PROCESS", "0") == "1"
+PLAYER_SYNC_INTERVAL = 300  # 5 минут
+BACKUP_DIR = os.path.join(BASE_DIR, 'backups')
+RESTART_BACKUP_FILE = os.path.join(BACKUP_DIR, 'restarts.ndjson')
+BACKUP_LOCK = threading.Lock()
+# Пул соединений к Bot API: все ответы идут по уже открытым keep-alive соединениям
+BOT_API_POOL_SIZE = 32
+# Сколько секунд игрок отдыхает в лагере после поражения
+RESPAWN_DELAY = 15
+# Как часто обновлять статистику планировщика SQLite (PRAGMA optimize)
+DB_OPTIMIZE_INTERVAL = 6 * 3600
+# Повторы отправки после RetryAfter (флуд-контроль Telegram) внутри AIORateLimiter
+SEND_MAX_RETRIES = 3
+# Окно, в котором повтор того же нажатия в чате заменяет предыдущее (двойной тап)
+MESSAGE_DEBOUNCE = 0.15
+PENDING_MESSAGES = {}  # chat_id -> (текст, задача), ждущая конца окна
+CHAT_LOCKS = {}  # chat_id -> [asyncio.Lock, число ждущих]; сообщения одного чата идут по очереди
 
 # Настройка логирования (ВНИМАНИЕ: используйте обычные пробелы, не неразрывные!)
 logging.basicConfig(
@@ -54,26 +103,130 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 # Загрузка всех данных
-with open(os.path.join('classes.json'), 'r', encoding='utf-8') as f:
-    CLASSES = json.load(f)
-with open(os.path.join('locations.json'), 'r', encoding='utf-8') as f:
-    LOCATIONS = json.load(f)
-with open(os.path.join('enemies.json'), 'r', encoding='utf-8') as f:
-    ENEMIES = json.load(f)
-with open(os.path.join('bosses.json'), 'r', encoding='utf-8') as f:
-    BOSSES = json.load(f)
-with open(os.path.join('quests.json'), 'r', encoding='utf-8') as f:
-    QUESTS = json.load(f)
-with open(os.path.join('items.json'), 'r', encoding='utf-8') as f:
-    ITEMS = json.load(f)
-with open(os.path.join('special_actions.json'), 'r', encoding='utf-8') as f:
-    SPECIAL_ACTIONS = json.load(f)
-with open(os.path.join('story.json'), 'r', encoding='utf-8') as f:
-    STORY = json.load(f)
-with open(os.path.join('random_events.json'), 'r', encoding='utf-8') as f:
-    RANDOM_EVENTS = json.load(f)
-with open(os.path.join('abilities.json'), 'r', encoding='utf-8') as f:
-    ABILITIES = json.load(f)
+def _jload(path):
+    # orjson заметно быстрее стандартного json; если его нет — работаем по-старому
+    if orjson is not None:
+        with open(path, 'rb') as f:
+            return orjson.loads(f.read())
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def _jdump_line(obj):
+    """Одна запись для JSONL-файла (с переводом строки)"""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_APPEND_NEWLINE)
+    return (json.dumps(obj, ensure_ascii=False) + '\n').encode('utf-8')
+
+class _Lazy(Mapping):
+    """Словарь, который строится при первом обращении (для редко нужных данных)"""
+
+    def __init__(self, build):
+        self._build = build
+        self._d = None
+
+    def _data(self):
+        if self._d is None:
+            self._d = self._build()
+        return self._d
+
+    def __getitem__(self, key):
+        return self._data()[key]
+
+    def __iter__(self):
+        return iter(self._data())
+
+    def __len__(self):
+        return len(self._data())
+
+    def __contains__(self, key):
+        return key in self._data()
+
+    def get(self, key, default=None):
+        return self._data().get(key, default)
+
+DATA_FILES = (
+    'classes.json', 'locations.json', 'enemies.json', 'quests.json',
+    'items.json', 'special_actions.json', 'abilities.json', 'bosses.json',
+)
+
+# Читаем файлы параллельно: пока один поток ждет диск, другой уже разбирает JSON
+with ThreadPoolExecutor(max_workers=8) as _loader:
+    (CLASSES, LOCATIONS, ENEMIES, QUESTS,
+     ITEMS, SPECIAL_ACTIONS, ABILITIES, BOSSES) = _loader.map(_jload, DATA_FILES)
+
+# Сюжет и случайные события нужны не в каждой сессии — читаем их по требованию.
+# Боссы читаются сразу: по ним строится BOSS_BIT, нужный при загрузке любого игрока
+STORY = _Lazy(lambda: _jload('story.json'))
+RANDOM_EVENTS = _Lazy(lambda: _jload('random_events.json'))
+
+# Разблокировки способностей по уровню: переводим ключи в int и сортируем один раз
+for _c in CLASSES.values():
+    _c['unlocks_sorted'] = sorted((int(lvl), tuple(skills)) for lvl, skills in _c.get('unlocks', {}).items())
+    _c['starting_abilities'] = tuple(_c.get('starting_abilities', ()))
+
+# Цена скупки и подписи кнопок магазина не меняются — форматируем их один раз
+for _item in ITEMS.values():
+    _item['sell_price'] = max(1, int(_item['price'] * 0.5))
+    _item['buy_label'] = f"{_item['name']} ({_item['price']}💰)"
+    _item['sell_label'] = f"{_item['name']} ({_item['sell_price']}💰)"
+    # Имя для подписей с parse_mode='Markdown': '_' или '*' в названии не сломают разметку
+    _item['name_md'] = escape_markdown(_item['name'])
+
+# Обратный индекс: название класса -> id
+CLASS_NAME_TO_ID = {c['name']: c_id for c_id, c in CLASSES.items()}
+# Обратный индекс: название предмета -> id
+ITEMS_BY_NAME = {item['name']: item_id for item_id, item in ITEMS.items()}
+# Обратный индекс целей квестов: id врага -> квесты, в которых его нужно убить
+QUESTS_BY_MOB = {}
+for _q_id, _q in QUESTS.items():
+    for _mob in _q.get('objectives', {}):
+        QUESTS_BY_MOB.setdefault(_mob, []).append(_q_id)
+
+# Действия локаций по тексту кнопки: loc_id -> {text: action}
+LOCATION_ACTION_INDEX = {
+    loc_id: {a['text']: a for a in loc.get('actions', [])}
+    for loc_id, loc in LOCATIONS.items()
+}
+
+# Бонусы артефактов в плоском виде: item_id -> ((stat, value), ...)
+ITEM_STATS = {
+    item_id: tuple(item.get('stats', {}).items())
+    for item_id, item in ITEMS.items() if item.get('type') == 'artifact'
+}
+
+# Сцены сюжета по id: storyline_key -> {scene_id: scene}
+STORY_SCENE_INDEX = _Lazy(lambda: {key: {s['id']: s for s in storyline} for key, storyline in STORY.items()})
+# Последняя сцена каждой сюжетной линии
+STORY_TERMINAL_SCENE = _Lazy(lambda: {key: (storyline[-1]['id'] if storyline else None) for key, storyline in STORY.items()})
+
+def get_story_scene(city, scene_id):
+    """Сцена сюжетной линии города по id за O(1); None, если такой нет"""
+    return STORY_SCENE_INDEX.get(f"{city}_storyline", {}).get(scene_id)
+
+# Случайные события города: loc_id -> (малые + средние события)
+def _build_city_events():
+    city_events = {}
+    for loc_id in LOCATIONS:
+        city_key = loc_id.replace("_square", "").replace("_city", "")
+        events = RANDOM_EVENTS.get(f"{city_key}_small_events", []) + RANDOM_EVENTS.get(f"{city_key}_medium_events", [])
+        if events:
+            city_events[loc_id] = tuple(events)
+    return city_events
+
+CITY_EVENTS = _Lazy(_build_city_events)
+
+# Битовые маски для наборов локаций и боссов: у каждого id свой бит
+LOC_BIT = {loc_id: 1 << i for i, loc_id in enumerate(LOCATIONS)}
+BOSS_BIT = {boss_id: 1 << i for i, boss_id in enumerate(BOSSES)}
+
+def to_mask(ids, bits):
+    mask = 0
+    for i in ids:
+        mask |= bits.get(i, 0)
+    return mask
+
+def from_mask(mask, bits):
+    return [i for i, bit in bits.items() if mask & bit]
 
 player_states = {}
 
@@ -94,41 +247,52 @@ DAMAGE_ICONS = {
 
 # --- PLAYER CLASS ---
 class Player:
-    def __init__(self, user_id):
+    def __init__(self, user_id, player_data=None):
         self.user_id = user_id
+        # Снимок строки и сброс _dirty идут под блокировкой игрока, а не общей
+        self._save_lock = threading.Lock()
 
-        # Пробуем загрузить из кэша
-        if user_id in PLAYER_CACHE:
-            cached_player = PLAYER_CACHE[user_id]
-            # Копируем все атрибуты
-            for attr, value in cached_player.__dict__.items():
-                setattr(self, attr, value)
-            self._is_cached = True
-            return
+        # Кэш бонусов от артефактов и эффектов (см. get_total_stats)
+        self._stats_ver = 0
+        self._bonus_cache = None
+        self._bonus_cache_ver = -1
 
-        # Загружаем из БД или создаем нового
-        player_data = db.get_full_player_data(user_id)
+        # Загружаем из БД или создаем нового (кэшем управляет get_player);
+        # aget_player передает уже прочитанные вне цикла событий данные
+        # ({} — игрока в БД нет, запись он создает сам в потоке БД)
+        read_here = player_data is None
+        if read_here:
+            player_data = db.get_full_player_data(user_id)
 
         if player_data:
             # Восстанавливаем из БД
             self._load_from_db(player_data)
-            self._is_cached = False
         else:
             # Создаем нового игрока
             self._create_new_player()
-            self._is_cached = False
+            if read_here:
+                db.create_player(user_id)
 
-        # Сохраняем в кэш
-        PLAYER_CACHE[user_id] = self
         self._last_save = time.time()
+        # Новый игрок попадает в ближайшее сохранение: в БД пока только голая строка
+        self._dirty = not player_data
+        self._pending = []  # операции для db.flush_batch (см. flush_player_writes)
+
+    def mark_dirty(self):
+        """Помечает игрока для ближайшего фонового сохранения"""
+        self._dirty = True
+
+    def defer_write(self, kind, *payload):
+        """Откладывает запись в БД до flush_player_writes (одна транзакция на действие)"""
+        self._pending.append((kind, *payload))
 
     def _load_from_db(self, data):
         """Загружает данные из базы данных"""
         self.class_name = data.get('class_name')
         self.base_stats = data.get('stats', {'health': 100, 'attack': 10, 'defense': 5})
         self.base_abilities = data.get('abilities', [])
-        self.inventory = data.get('inventory', [])
-        self.equipped_artifacts = data.get('equipped_items', [])
+        self.inventory = Counter(data.get('inventory', {}))  # item_id -> количество
+        self.equipped_artifacts = set(data.get('equipped_items', ()))
         self.artifact_slots = data.get('artifact_slots', 1)
         self.gold = data.get('gold', 50)
         self.active_effects = data.get('active_effects', [])
@@ -138,26 +302,32 @@ class Player:
         self.level = data.get('level', 1)
         self.experience = data.get('experience', 0)
         self.kill_count = data.get('kill_count', {})
-        self.visited_locations = set(data.get('unlocked_locations', ['village_square']))
-        self.defeated_bosses = set(data.get('defeated_bosses', []))
+        self.visited_mask = to_mask(data.get('unlocked_locations', ['village_square']), LOC_BIT)
+        self.defeated_bosses_mask = to_mask(data.get('defeated_bosses', []), BOSS_BIT)
         self.current_city = data.get('current_city', 'village_square')
         self.camp_entry_time = data.get('camp_entry_time', 0)
         self.fatigue = data.get('fatigue', 100)
-        self.last_fatigue_update = data.get('last_fatigue_update', time.time())
+        self.last_fatigue_update = data.get('last_fatigue_update') or time.time()
         self.story_progress = data.get('story_progress', {})
-        self.unlocked_cities = set(data.get('unlocked_locations', ['village_square']))
+        self.unlocked_mask = to_mask(data.get('unlocked_locations', ['village_square']), LOC_BIT)
         self.last_location = data.get('last_location', 'village_square')
 
+        # То, что уже лежит в БД: при сохранении пишем только разницу
+        self._saved_quests = set(self.active_quests)
+        self._saved_abilities = set(self.base_abilities)
+        self._saved_cities_mask = self.unlocked_mask
+        self.invalidate_stats()
+
         # Обновляем усталость
         self.update_fatigue()
 
     def _create_new_player(self):
-        """Создает нового игрока и сохраняет в БД"""
+        """Заполняет стартовые значения нового игрока (запись в БД создает вызывающий)"""
         self.class_name = None
         self.base_stats = {'health': 100, 'attack': 10, 'defense': 5}
         self.base_abilities = []
-        self.inventory = []
-        self.equipped_artifacts = []
+        self.inventory = Counter()
+        self.equipped_artifacts = set()
         self.artifact_slots = 1
         self.gold = 50
         self.active_effects = []
@@ -167,65 +337,40 @@ class Player:
         self.level = 1
         self.experience = 0
         self.kill_count = {}
-        self.visited_locations = set(["village_square"])
-        self.defeated_bosses = set()
+        self.visited_mask = LOC_BIT["village_square"]
+        self.defeated_bosses_mask = 0
         self.current_city = "village_square"
         self.camp_entry_time = 0
         self.fatigue = 100
         self.last_fatigue_update = time.time()
         self.story_progress = {}
-        self.unlocked_cities = set(["village_square"])
+        self.unlocked_mask = LOC_BIT["village_square"]
         self.last_location = "village_square"
 
-        # Создаем запись в БД
-        db.create_player(self.user_id)
+        self._saved_quests = set()
+        self._saved_abilities = set()
+        self._saved_cities_mask = LOC_BIT["village_square"]
 
     def save(self, force: bool = False):
         """Сохраняет игрока в базу данных"""
         current_time = time.time()
 
+        # Без изменений сохранять нечего
+        if not force and not self._dirty:
+            return True
+
         # Сохраняем не чаще чем раз в 30 секунд (если не принудительно)
         if not force and hasattr(self, '_last_save') and current_time - self._last_save < 30:
             return True
 
         try:
-            # Обновляем основные данные
-            db.update_player(
-                user_id=self.user_id,
-                class_name=self.class_name,
-                level=self.level,
-                experience=self.experience,
-                gold=self.gold,
-                fatigue=self.fatigue,
-                last_fatigue_update=self.last_fatigue_update,
-                artifact_slots=self.artifact_slots,
-                current_location=self.location,
-                current_city=self.current_city,
-                last_location=self.last_location,
-                camp_entry_time=self.camp_entry_time
-            )
-
-            # Обновляем статистику
-            db.update_player_stats(
-                user_id=self.user_id,
-                health=self.base_stats.get('health', 100),
-                attack=self.base_stats.get('attack', 10),
-                defense=self.base_stats.get('defense', 5)
-            )
-
-            # Сохраняем активные квесты
-            for quest_id in self.active_quests:
-                db.start_quest(self.user_id, quest_id)
+            # Записи уходят в очередь фонового потока БД; обработчик не ждет диска
+            with self._save_lock:
+                db.save_players([(self.user_id, self.to_row())])
+                self._queue_deltas()
 
-            # Сохраняем способности
-            for ability in self.get_all_abilities():
-                db.add_ability(self.user_id, ability)
-
-            # Сохраняем открытые локации
-            for location in self.unlocked_cities:
-                db.unlock_location(self.user_id, location)
-
-            self._last_save = current_time
+                self._last_save = current_time
+                self._dirty = False
             logger.debug(f"💾 Saved player {self.user_id}")
             return True
 
@@ -233,8 +378,48 @@ class Player:
             logger.error(f"Failed to save player {self.user_id}: {e}")
             return False
 
+    def to_row(self):
+        """Строка для db.save_players: поля GameDatabase.PLAYER_ROW_FIELDS по порядку"""
+        return (
+            self.class_name,
+            self.level,
+            self.experience,
+            self.gold,
+            self.fatigue,
+            self.last_fatigue_update,
+            self.artifact_slots,
+            self.location,
+            self.current_city,
+            self.last_location,
+            self.camp_entry_time,
+            self.base_stats.get('health', 100),
+            self.base_stats.get('attack', 10),
+            self.base_stats.get('defense', 5)
+        )
+
+    def _queue_deltas(self):
+        """Ставит в очередь только новые квесты, способности и локации"""
+        new_quests = [q for q in self.active_quests if q not in self._saved_quests]
+        if new_quests:
+            db.queue_write('quests', self.user_id, new_quests)
+            self._saved_quests.update(new_quests)
+
+        new_abilities = [a for a in self.get_all_abilities() if a not in self._saved_abilities]
+        if new_abilities:
+            db.queue_write('abilities', self.user_id, new_abilities)
+            self._saved_abilities.update(new_abilities)
+
+        new_cities_mask = self.unlocked_mask & ~self._saved_cities_mask
+        if new_cities_mask:
+            db.queue_write('locations', self.user_id, from_mask(new_cities_mask, LOC_BIT))
+            self._saved_cities_mask |= new_cities_mask
+
     def sync_from_db(self):
         """Синхронизирует данные из БД (если другой процесс мог изменить)"""
+        # Сначала отдаем свои изменения, иначе чтение затрет их старым состоянием
+        if self._dirty:
+            self.save(force=True)
+        db.flush_writes()
         player_data = db.get_full_player_data(self.user_id)
         if player_data:
             self._load_from_db(player_data)
@@ -246,6 +431,8 @@ class Player:
         passed = current_time - self.last_fatigue_update
         gain = passed * (100 / 3600)
         if gain > 0:
+            if self.fatigue < 100:
+                self._dirty = True
             self.fatigue = min(100, self.fatigue + gain)
             self.last_fatigue_update = current_time
 
@@ -257,37 +444,55 @@ class Player:
         self.update_fatigue()
         self.fatigue = max(0, self.fatigue - amount)
         self.last_fatigue_update = time.time()
+        self._dirty = True
+
+    def invalidate_stats(self):
+        """Сбрасывает кэш бонусов: вызывать при смене артефактов или эффектов"""
+        self._stats_ver += 1
 
     def get_total_stats(self):
+        # Бонусы артефактов и эффектов меняются редко — пересчитываем только после invalidate_stats()
+        if self._bonus_cache_ver != self._stats_ver:
+            bonus = {}
+            for item_id in self.equipped_artifacts:
+                for stat, value in ITEM_STATS.get(item_id, ()):
+                    bonus[stat] = bonus.get(stat, 0) + value
+            for effect in self.active_effects:
+                for stat, value in effect.get('stats', {}).items():
+                    bonus[stat] = bonus.get(stat, 0) + value
+            self._bonus_cache = bonus
+            self._bonus_cache_ver = self._stats_ver
+
+        # Базовые статы и золото меняются напрямую в обработчиках, поэтому читаем их каждый раз
         stats = self.base_stats.copy()
         stats['gold'] = self.gold
-        for item_id in self.equipped_artifacts:
-            item = ITEMS.get(item_id)
-            if item and 'stats' in item:
-                for stat, value in item['stats'].items():
-                    stats[stat] = stats.get(stat, 0) + value
-        for effect in self.active_effects:
-            for stat, value in effect.get('stats', {}).items():
-                stats[stat] = stats.get(stat, 0) + value
+        for stat, value in self._bonus_cache.items():
+            stats[stat] = stats.get(stat, 0) + value
         return stats
 
     def add_effect(self, name, stats, duration):
         self.active_effects.append({'name': name, 'stats': stats, 'duration': duration})
-        # Сохраняем в БД
-        db.add_effect(self.user_id, name, stats, duration)
+        self.invalidate_stats()
+        self.defer_write('effect', name, stats, duration)
+        self._dirty = True
 
     def tick_effects(self):
-        expired = []
+        surviving = []
+        expired_names = []
         for effect in self.active_effects:
             effect['duration'] -= 1
             if effect['duration'] <= 0:
-                expired.append(effect)
-        for e in expired:
-            if e in self.active_effects:
-                self.active_effects.remove(e)
-                # Удаляем из БД
-                db.remove_effect(self.user_id, e['name'])
-        return len(expired) > 0
+                expired_names.append(effect['name'])
+            else:
+                surviving.append(effect)
+        if not expired_names:
+            return False
+        self.active_effects = surviving
+        self.invalidate_stats()
+        for name in expired_names:
+            self.defer_write('effect_end', name)
+        self._dirty = True
+        return True
 
     def get_max_health(self):
         c_data = CLASSES.get(self.class_name)
@@ -298,16 +503,31 @@ class Player:
         # Base (Level 1) abilities
         abilities = set(self.base_abilities)
 
-        # Check for Level Unlocks defined in Classes
+        # Check for Level Unlocks defined in Classes (sorted by level at load time)
         c_data = CLASSES.get(self.class_name)
-        if c_data and 'unlocks' in c_data:
-            for lvl_req, unlocked_abs in c_data['unlocks'].items():
-                if self.level >= int(lvl_req):
-                    for ab in unlocked_abs:
-                        abilities.add(ab)
+        if c_data:
+            for lvl_req, unlocked_abs in c_data['unlocks_sorted']:
+                if lvl_req > self.level:
+                    break
+                abilities.update(unlocked_abs)
 
         return list(abilities)
 
+    def add_item(self, item_id, quantity=1):
+        """Кладет предмет в инвентарь; запись в БД уходит с ближайшим flush_player_writes"""
+        self.inventory[item_id] += quantity
+        self.defer_write('item', item_id, quantity)
+        self._dirty = True
+
+    def remove_item(self, item_id):
+        """Убирает из инвентаря один предмет; нулевые записи удаляются"""
+        if self.inventory[item_id] <= 1:
+            del self.inventory[item_id]
+        else:
+            self.inventory[item_id] -= 1
+        self.defer_write('item', item_id, -1)
+        self._dirty = True
+
     def equip_artifact(self, item_id):
         if item_id not in self.inventory: return False, "Нет в инвентаре."
         if item_id in self.equipped_artifacts: return False, "Уже надето."
@@ -315,71 +535,229 @@ class Player:
         if not item or item.get('type') != 'artifact': return False, "Это не артефакт."
         if len(self.equipped_artifacts) >= self.artifact_slots:
             return False, f"Нет свободных слотов ({len(self.equipped_artifacts)}/{self.artifact_slots}). Снимите что-нибудь."
-        self.equipped_artifacts.append(item_id)
-        # Сохраняем в БД
-        db.equip_item(self.user_id, item_id)
+        self.equipped_artifacts.add(item_id)
+        self.invalidate_stats()
+        self.defer_write('equip', item_id)
+        self._dirty = True
         return True, "Артефакт надет."
 
     def unequip_artifact(self, item_id):
         if item_id in self.equipped_artifacts:
-            self.equipped_artifacts.remove(item_id)
-            # Сохраняем в БД
-            db.unequip_item(self.user_id, item_id)
+            self.equipped_artifacts.discard(item_id)
+            self.invalidate_stats()
+            self.defer_write('unequip', item_id)
+            self._dirty = True
             return True, "Артефакт снят."
         return False, "Не надето."
 
+    @property
+    def unlocked_cities(self):
+        """Открытые локации (список id в порядке locations.json)"""
+        return from_mask(self.unlocked_mask, LOC_BIT)
+
+    @property
+    def defeated_bosses(self):
+        return from_mask(self.defeated_bosses_mask, BOSS_BIT)
+
+    def has_location(self, loc_id):
+        return bool(self.unlocked_mask & LOC_BIT.get(loc_id, 0))
+
     def unlock_city(self, city_id):
-        self.unlocked_cities.add(city_id)
-        # Сохраняем в БД
-        db.unlock_location(self.user_id, city_id)
+        self.unlocked_mask |= LOC_BIT.get(city_id, 0)
+        # Новые локации пишет _queue_deltas при ближайшем сохранении
+        self._dirty = True
 
     def has_completed_story(self, city):
-        storyline = STORY.get(f"{city}_storyline", [])
-        if not storyline: return False
-        last_scene_id = storyline[-1]["id"]
+        last_scene_id = STORY_TERMINAL_SCENE.get(f"{city}_storyline")
+        if last_scene_id is None: return False
         return self.story_progress.get(city) == last_scene_id
 
 def get_player(user_id):
-    """Получает игрока из кэша или создает нового"""
+    """Получает игрока из кэша или создает нового (обработчики вызывают aget_player)"""
     # Проверяем кэш
     if user_id in PLAYER_CACHE:
-        player = PLAYER_CACHE[user_id]
-        # Проверяем, не устарели ли данные (больше 5 минут)
-        if time.time() - getattr(player, '_last_sync', 0) < 300:
-            return player
-        else:
-            # Синхронизируем из БД
-            player.sync_from_db()
-            player._last_sync = time.time()
-            return player
+        PLAYER_CACHE.move_to_end(user_id)
+        return PLAYER_CACHE[user_id]
 
     # Создаем нового игрока (он сам загрузится из БД или создастся)
-    player = Player(user_id)
-    PLAYER_CACHE[user_id] = player
+    return _cache_player(Player(user_id))
+
+def _cache_player(player):
+    PLAYER_CACHE[player.user_id] = player
     player._last_sync = time.time()
 
+    # Вытесняем давно неактивных игроков, предварительно сохранив их.
+    # Запись уходит в поток БД после уже поставленных пачек игрока и не держит цикл событий
+    while len(PLAYER_CACHE) > MAX_CACHED_PLAYERS:
+        _, evicted = PLAYER_CACHE.popitem(last=False)
+        submit_pending(evicted)
+        db_async.submit(evicted.save, force=True)
+
     return player
 
+async def aget_player(user_id):
+    """get_player для обработчиков: игрока, которого нет в кэше, читаем из БД вне цикла событий"""
+    player = PLAYER_CACHE.get(user_id)
+    if player is not None:
+        PLAYER_CACHE.move_to_end(user_id)
+        # В одном процессе кэш — единственный источник правды, перечитывать БД незачем
+        if not MULTI_PROCESS or time.time() - player._last_sync < PLAYER_SYNC_INTERVAL:
+            return player
+        # Данные могли измениться другим процессом: отложенные операции уходят в БД
+        # первыми, затем перечитываем игрока в потоке БД
+        player._last_sync = time.time()
+        await flush_player_writes(player)
+        await db_async.sync_player(player)
+        return player
+
+    player_data = await db_async.get_full_player_data(user_id)
+    # Пока шло чтение, игрока мог загрузить другой обработчик
+    if user_id not in PLAYER_CACHE:
+        _cache_player(Player(user_id, player_data or {}))
+        if not player_data:
+            # Новый игрок: запись создается в потоке БД раньше любых его сохранений
+            await db_async.create_player(user_id)
+    return get_player(user_id)
+
+# --- КАРТИНКИ ---
+# Telegram отдает file_id загруженной картинки; по нему повторная отправка не скачивает URL заново
+PHOTO_CACHE = db.get_photo_file_ids()  # url -> file_id
+
+@lru_cache(maxsize=64)
+def read_local_photo(path):
+    """Байты локальной картинки; файл читается с диска один раз за процесс"""
+    with open(os.path.join(BASE_DIR, path), 'rb') as f:
+        return f.read()
+
+def photo_source(photo):
+    """URL отправляем как есть, локальный путь (относительно папки бота) — содержимым файла"""
+    if isinstance(photo, str) and not photo.startswith(('http://', 'https://')):
+        return read_local_photo(photo)
+    return photo
+
+async def send_photo_cached(bot, *, chat_id, photo, **kwargs):
+    """send_photo, который отправляет картинку по file_id, если она уже уходила раньше"""
+    file_id = PHOTO_CACHE.get(photo)
+    if file_id:
+        try:
+            return await bot.send_photo(chat_id=chat_id, photo=file_id, **kwargs)
+        except BadRequest as e:
+            # file_id мог устареть (например, сменился токен бота) — отправляем заново
+            logger.warning(f"Cached photo rejected for {photo}: {e}")
+            PHOTO_CACHE.pop(photo, None)
+            await db_async.save_photo_file_id(photo, None)
+
+    message = await bot.send_photo(chat_id=chat_id, photo=photo_source(photo), **kwargs)
+    if isinstance(photo, str) and message and message.photo:
+        PHOTO_CACHE[photo] = message.photo[-1].file_id
+        await db_async.save_photo_file_id(photo, PHOTO_CACHE[photo])
+    return message
+
+def submit_pending(player):
+    """Отправляет накопленные операции игрока в поток БД; возвращает Future или None.
+
+    Снятие _pending и постановка в очередь идут под блокировкой игрока, поэтому
+    пачки одного игрока попадают в БД в том же порядке, в каком накопились.
+    """
+    with player._save_lock:
+        if not player._pending:
+            return None
+        ops, player._pending = player._pending, []
+        future = db_async.submit(db.flush_batch, player.user_id, ops)
+    future.add_done_callback(partial(_restore_pending, player, ops))
+    return future
+
+def _restore_pending(player, ops, future):
+    """Неудачную пачку возвращаем в начало _pending — повторится при следующем сбросе"""
+    if not future.cancelled() and future.exception() is None:
+        return
+    with player._save_lock:
+        player._pending[:0] = ops
+    logger.error(f"Failed to flush writes for player {player.user_id}, {len(ops)} ops kept for retry")
+
+async def flush_player_writes(player):
+    """Пишет накопленные операции игрока одной транзакцией вне цикла событий"""
+    future = submit_pending(player)
+    if future is not None:
+        await asyncio.wrap_future(future)
+
+async def optimize_database(context: ContextTypes.DEFAULT_TYPE):
+    """Периодический PRAGMA optimize для долго работающего бота"""
+    await db_async.optimize()
+
+async def flush_dirty_players(context: ContextTypes.DEFAULT_TYPE):
+    """Сохраняет игроков, изменившихся с прошлого сброса (одна запись на игрока)"""
+    for player in list(PLAYER_CACHE.values()):
+        if player._pending:
+            await flush_player_writes(player)
+        if player._dirty:
+            await db_async.save_player(player, force=True)
+
 def get_keyboard_layout(buttons, cols=2):
     return [buttons[i:i + cols] for i in range(0, len(buttons), cols)]
 
+# --- ГОТОВЫЕ КЛАВИАТУРЫ ---
+# ReplyKeyboardMarkup неизменяем, поэтому один объект можно отдавать всем игрокам
+CLASS_SELECTION_KB = ReplyKeyboardMarkup(
+    get_keyboard_layout([KeyboardButton(f"👁️ {c['name']}") for c in CLASSES.values()], 2),
+    resize_keyboard=True
+)
+LOCATION_KB_CACHE = {}  # (тексты действий, телепорт, город) -> ReplyKeyboardMarkup
+
+@lru_cache(maxsize=256)
+def build_markup(rows):
+    """Клавиатура по кортежу строк с подписями кнопок; одинаковые раскладки переиспользуются"""
+    return ReplyKeyboardMarkup([[KeyboardButton(t) for t in row] for row in rows], resize_keyboard=True)
+
+def labels_markup(labels, cols=2):
+    """То же, что get_keyboard_layout + ReplyKeyboardMarkup, но из кэша build_markup"""
+    return build_markup(tuple(tuple(labels[i:i + cols]) for i in range(0, len(labels), cols)))
+
+EVENT_END_KB = build_markup((("🎲 Еще событие",), ("🏠 Вернуться в город",)))
+BACK_KB = build_markup((("⬅️ Назад",),))
+STATS_KB = build_markup((("💾 Сохранить сейчас",), ("⬅️ Назад",)))
+CLASS_PREVIEW_KB = build_markup((("✅ Выбрать этот класс",), ("⬅️ Назад к выбору класса",)))
+CONFIRM_BUY_KB = build_markup((("✅ Подтвердить покупку",), ("⬅️ Назад",)))
+CONFIRM_SELL_KB = build_markup((("✅ Подтвердить продажу",), ("⬅️ Назад",)))
+
+# Временные состояния user_data, сбрасываемые при переходе в локацию
+_TRANSIENT_KEYS = frozenset({
+    'in_battle', 'in_story', 'in_shop', 'in_shop_sell', 'in_inventory',
+    'in_city_teleport', 'viewing_item', 'in_random_event', 'current_event_chain',
+    'battle_potion_menu', 'shop_confirm_buy', 'shop_confirm_sell',
+    'buy_labels', 'sell_labels'
+})
+
 # --- DAMAGE CALCULATION SYSTEM (UPDATED WITH RESISTANCE) ---
-def calculate_single_layer_damage(base_attack, multiplier, dmg_type, resistances):
-    # Base calculation
-    raw = base_attack * multiplier
+_rand = random.random  # randint() goes through randrange(); one C call is enough here
 
-    # Resistance Check
+def resistance_multipliers(resistances):
     # Resistance is 0.0 to 1.0 (percent blocked). Negative means weakness (bonus damage).
-    # Cap at 1.0 (immune).
-    res_val = resistances.get(dmg_type, 0.0)
-    res_factor = max(0.0, 1.0 - res_val)
+    # Cap at 1.0 (immune). Computed once per battle phase; missing types mean x1.0.
+    return {dmg_type: max(0.0, 1.0 - res_val) for dmg_type, res_val in resistances.items()}
 
-    final_val = raw * res_factor
+def calculate_single_layer_damage(base_attack, multiplier, dmg_type, res_mult):
+    # Base calculation with the precomputed resistance factor
+    final_val = base_attack * multiplier * res_mult.get(dmg_type, 1.0)
 
     # Random Variance
     min_dmg = int(final_val * 0.8)
     max_dmg = int(final_val * 1.2)
-    return max(1, random.randint(min_dmg, max_dmg))
+    return max(1, min_dmg + int(_rand() * (max_dmg - min_dmg + 1)))
+
+def calculate_damage_batch(base_attack, layers, res_mult):
+    # Same formula as calculate_single_layer_damage, but for all layers of an ability
+    # (or all AoE/DoT hits of a tick) in one loop with the lookups hoisted out.
+    # layers: iterable of {"mult": float, "type": str}
+    res_get = res_mult.get
+    rand = _rand
+    out = []
+    for layer in layers:
+        final_val = base_attack * layer["mult"] * res_get(layer["type"], 1.0)
+        min_dmg = int(final_val * 0.8)
+        max_dmg = int(final_val * 1.2)
+        out.append(max(1, min_dmg + int(rand() * (max_dmg - min_dmg + 1))))
+    return out
 
 async def generic_back_button(update, context, player):
     if context.user_data.get('in_inventory'):
@@ -401,7 +779,7 @@ async def generic_back_button(update, context, player):
 # --- CORE GAMEPLAY ---
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    player = get_player(update.effective_user.id)
+    player = await aget_player(update.effective_user.id)
     if player.class_name:
         if context.user_data.get('in_battle'):
              await update.message.reply_text("⚔️ Вы находитесь в бою! Закончите его или сбегите.")
@@ -414,9 +792,17 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     else:
         await show_class_selection(update, context, player)
 
+def append_restart_backup(backup_data):
+    """Дописывает бэкап игрока одной строкой в backups/restarts.ndjson"""
+    line = _jdump_line(backup_data)
+    with BACKUP_LOCK:
+        os.makedirs(BACKUP_DIR, exist_ok=True)
+        with open(RESTART_BACKUP_FILE, 'ab') as f:
+            f.write(line)
+
 async def restart(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
-    player = get_player(uid)
+    player = await aget_player(uid)
 
     # Создаем бэкап данных игрока перед удалением
     backup_data = {
@@ -424,17 +810,16 @@ async def restart(update: Update, context: ContextTypes.DEFAULT_TYPE):
         'class_name': player.class_name,
         'level': player.level,
         'gold': player.gold,
-        'inventory': player.inventory.copy(),
+        'inventory': player.inventory,  # сериализатор не меняет словарь, копия не нужна
         'timestamp': time.time()
     }
 
-    # Сохраняем бэкап в отдельный файл
-    backup_dir = os.path.join(BASE_DIR, 'backups')
-    os.makedirs(backup_dir, exist_ok=True)
+    # Дописываем бэкап в общий журнал, не блокируя цикл событий
+    await asyncio.get_running_loop().run_in_executor(None, append_restart_backup, backup_data)
 
-    backup_file = os.path.join(backup_dir, f'player_{uid}_{int(time.time())}.json')
-    with open(backup_file, 'w', encoding='utf-8') as f:
-        json.dump(backup_data, f, ensure_ascii=False, indent=2)
+    # Дописываем отложенные изменения, иначе они пропадут вместе с записью в кэше
+    await flush_player_writes(player)
+    await db_async.save_player(player, force=True)
 
     # Удаляем из кэша
     if uid in PLAYER_CACHE:
@@ -444,7 +829,7 @@ async def restart(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data.clear()
 
     # Создаем нового игрока
-    player = get_player(uid)
+    player = await aget_player(uid)
 
     await update.message.reply_text(
         "🔄 **Игра перезапущена!**\n\n"
@@ -459,14 +844,13 @@ async def restart(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def show_class_selection(update, context, player):
     player.location = "class_selection"
     if 'selected_class' in context.user_data: del context.user_data['selected_class']
-    buttons = [KeyboardButton(f"👁️ {c['name']}") for c in CLASSES.values()]
-    layout = get_keyboard_layout(buttons, 2)
-    await context.bot.send_photo(
+    await send_photo_cached(
+        context.bot,
         chat_id=update.effective_chat.id,
         photo="https://i.imgur.com/3Vk5Q7a.jpeg",
         caption="**🎯 Выберите ваш класс**\n\nНажмите на класс чтобы посмотреть его характеристики.",
         parse_mode='Markdown',
-        reply_markup=ReplyKeyboardMarkup(layout, resize_keyboard=True)
+        reply_markup=CLASS_SELECTION_KB
     )
 
 async def handle_class_selection(update, context, player, text):
@@ -476,7 +860,7 @@ async def handle_class_selection(update, context, player, text):
 
     if text.startswith("👁️ "):
         c_name = text[3:]
-        c_id = next((k for k, v in CLASSES.items() if v['name'] == c_name), None)
+        c_id = CLASS_NAME_TO_ID.get(c_name)
 
         if c_id:
             c_data = CLASSES[c_id]
@@ -493,19 +877,15 @@ async def handle_class_selection(update, context, player, text):
                 f"🔮 **Способности:**\n{abilities}"
             )
 
-            kb = [
-                [KeyboardButton("✅ Выбрать этот класс")],
-                [KeyboardButton("⬅️ Назад к выбору класса")]
-            ]
-
             context.user_data['selected_class'] = c_id
 
-            await context.bot.send_photo(
+            await send_photo_cached(
+                context.bot,
                 chat_id=update.effective_chat.id,
                 photo=c_data['image'],
                 caption=msg,
                 parse_mode='Markdown',
-                reply_markup=ReplyKeyboardMarkup(kb, resize_keyboard=True)
+                reply_markup=CLASS_PREVIEW_KB
             )
 
     elif text == "✅ Выбрать этот класс":
@@ -518,15 +898,12 @@ async def handle_class_selection(update, context, player, text):
         # Сохраняем выбор класса
         player.class_name = c_id
         player.base_stats = CLASSES[c_id]['base_stats'].copy()
-        player.base_abilities = CLASSES[c_id]['starting_abilities'].copy()
+        player.base_abilities = list(CLASSES[c_id]['starting_abilities'])
 
-        # Сохраняем начальные способности в БД
-        for ability in player.base_abilities:
-            db.add_ability(player.user_id, ability)
-
-        # Обновляем статистику в БД
-        db.update_player_stats(
-            user_id=player.user_id,
+        # Начальные способности и статистика — одной транзакцией
+        await db_async.init_class(
+            player.user_id,
+            player.base_abilities,
             health=player.base_stats['health'],
             attack=player.base_stats['attack'],
             defense=player.base_stats['defense']
@@ -536,8 +913,8 @@ async def handle_class_selection(update, context, player, text):
         if 'selected_class' in context.user_data:
             del context.user_data['selected_class']
 
-        # Сохраняем выбор класса в БД
-        player.save(force=True)
+        # Выбор класса попадет в БД при ближайшем фоновом сохранении
+        player.mark_dirty()
 
         # Отправляем сообщение
         await update.message.reply_text(
@@ -581,11 +958,9 @@ async def start_quest(update, context, player, quest_id):
     if requirements_met:
         player.active_quests.append(quest_id)
 
-        # Сохраняем квест в БД
-        db.start_quest(player.user_id, quest_id)
-
-        # Сохраняем игрока
-        player.save(force=True)
+        # Сохраняем квест в БД сразу; _queue_deltas его уже не повторит
+        await db_async.start_quest(player.user_id, quest_id)
+        player._saved_quests.add(quest_id)
 
         # Отправляем сообщение о начале квеста
         quest_text = f"📜 **Новый квест: {quest['name']}**\n\n{quest['description']}"
@@ -618,15 +993,40 @@ async def start_intro_story(update, context, player, quest_id=None):
     player.current_city = "village_square"
     await show_location(update, context, player, "village_square")
 
-async def show_location(update, context, player, loc_id):
-    # Очистка всех временных состояний
-    keys = ['in_battle', 'in_story', 'in_shop', 'in_shop_sell', 'in_inventory',
-            'in_city_teleport', 'viewing_item', 'in_random_event', 'current_event_chain',
-            'battle_potion_menu', 'shop_confirm_buy', 'shop_confirm_sell']
+def get_location_markup(action_texts, can_teleport, is_city):
+    """Клавиатура локации. Зависит только от набора видимых кнопок, поэтому кэшируется"""
+    key = (action_texts, can_teleport, is_city)
+    markup = LOCATION_KB_CACHE.get(key)
+    if markup is not None:
+        return markup
+
+    # Формируем раскладку кнопок
+    menu = get_keyboard_layout([KeyboardButton(t) for t in action_texts], 2)
+
+    # Нижние кнопки (всегда доступные)
+    footer = []
+
+    if can_teleport:
+        footer.append([KeyboardButton("🚀 Телепортация")])
 
-    for key in keys:
-        if key in context.user_data:
-            del context.user_data[key]
+    footer.append([KeyboardButton("📊 Характеристики"), KeyboardButton("🎒 Инвентарь")])
+
+    if not is_city:
+        footer.append([KeyboardButton("🏠 В город")])
+
+    # Добавляем кнопку сохранения для тестирования
+    # footer.append([KeyboardButton("💾 Сохранить")])
+
+    markup = ReplyKeyboardMarkup(menu + footer, resize_keyboard=True)
+    LOCATION_KB_CACHE[key] = markup
+    return markup
+
+async def show_location(update, context, player, loc_id, chat_id=None):
+    """Показывает локацию. Без update (из задач JobQueue) нужно передать chat_id"""
+    # Очистка всех временных состояний
+    user_data = context.user_data
+    for key in _TRANSIENT_KEYS:
+        user_data.pop(key, None)
 
     # Получаем данные локации
     location = LOCATIONS.get(loc_id)
@@ -639,20 +1039,19 @@ async def show_location(update, context, player, loc_id):
     # Обновляем данные игрока
     player.location = loc_id
     player.last_location = loc_id
-    player.visited_locations.add(loc_id)
+    player.visited_mask |= LOC_BIT[loc_id]
 
     if location.get('is_city'):
         player.current_city = loc_id
 
     # Сохраняем посещенную локацию в БД
-    if loc_id not in player.unlocked_cities:
-        player.unlocked_cities.add(loc_id)
-        db.unlock_location(player.user_id, loc_id)
+    if not player.has_location(loc_id):
+        player.unlock_city(loc_id)
 
-    # Сохраняем текущее местоположение в БД
-    player.save(force=True)
+    # Текущее местоположение попадет в БД при ближайшем фоновом сохранении
+    player.mark_dirty()
 
-    # Создаем кнопки действий
+    # Создаем кнопки действий (только тексты; сама клавиатура берется из кэша)
     buttons = []
     for action in location.get("actions", []):
         # Проверяем условия для отображения действия
@@ -663,7 +1062,7 @@ async def show_location(update, context, player, loc_id):
             if player.has_completed_story(city):
                 show_action = False
 
-        if action.get("target") == "capital_city" and "capital_city" not in player.unlocked_cities:
+        if action.get("target") == "capital_city" and not player.has_location("capital_city"):
             show_action = False
 
         if action.get("required_level", 0) > player.level:
@@ -673,35 +1072,19 @@ async def show_location(update, context, player, loc_id):
             show_action = False
 
         if show_action:
-            buttons.append(KeyboardButton(action["text"]))
-
-    # Формируем раскладку кнопок
-    menu = get_keyboard_layout(buttons, 2)
-
-    # Нижние кнопки (всегда доступные)
-    footer = []
-
-    if len(player.unlocked_cities) > 1 and location.get('is_city'):
-        footer.append([KeyboardButton("🚀 Телепортация")])
-
-    footer.append([KeyboardButton("📊 Характеристики"), KeyboardButton("🎒 Инвентарь")])
-
-    if not location.get('is_city'):
-        footer.append([KeyboardButton("🏠 В город")])
-
-    # Добавляем кнопку сохранения для тестирования
-    # footer.append([KeyboardButton("💾 Сохранить")])
+            buttons.append(action["text"])
 
-    # Объединяем все кнопки
-    all_buttons = menu + footer
+    is_city = bool(location.get('is_city'))
+    can_teleport = player.unlocked_mask.bit_count() > 1 and is_city
 
     # Отправляем сообщение с локацией
-    await context.bot.send_photo(
-        chat_id=update.effective_chat.id,
+    await send_photo_cached(
+        context.bot,
+        chat_id=chat_id or update.effective_chat.id,
         photo=location.get("image", "https://i.imgur.com/3Vk5Q7a.jpeg"),
         caption=f"**{location['name']}**\n\n{location['description']}",
         parse_mode='Markdown',
-        reply_markup=ReplyKeyboardMarkup(all_buttons, resize_keyboard=True)
+        reply_markup=get_location_markup(tuple(buttons), can_teleport, is_city)
     )
 
 async def handle_location_action(update, context, player, text):
@@ -709,7 +1092,7 @@ async def handle_location_action(update, context, player, text):
     if not loc:
         await show_location(update, context, player, player.current_city)
         return False
-    action = next((a for a in loc.get("actions", []) if a["text"] == text), None)
+    action = LOCATION_ACTION_INDEX.get(player.location, {}).get(text)
     if action:
         t, target = action["type"], action.get("target")
         if t == "location": await show_location(update, context, player, target)
@@ -731,30 +1114,28 @@ async def start_story_line(update, context, player, city):
     if not current_scene_id:
         current_scene_id = storyline[0]["id"]
         player.story_progress[city] = current_scene_id
-    context.user_data['current_story'] = {'type': 'main_story', 'city': city, 'current_scene': current_scene_id, 'storyline': storyline}
+    context.user_data['current_story'] = {'type': 'main_story', 'city': city, 'current_scene': current_scene_id}
     await show_story_scene(update, context, player, city, current_scene_id)
 
 async def show_story_scene(update, context, player, city, scene_id):
     story_data = context.user_data.get('current_story')
     if not story_data: return
-    scene = next((s for s in story_data['storyline'] if s["id"] == scene_id), None)
+    scene = get_story_scene(city, scene_id)
     if not scene: return
 
     context.user_data['in_story'] = True
     context.user_data['current_story']['current_scene'] = scene_id
 
     scene_type = scene["type"]
-    keyboard = []
-    if scene_type == "dialogue": keyboard.append([KeyboardButton("➡️ Продолжить")])
-    keyboard.append([KeyboardButton("🏠 Вернуться в город")])
 
     if scene_type == "dialogue":
-        await context.bot.send_photo(
+        await send_photo_cached(
+            context.bot,
             chat_id=update.effective_chat.id,
             photo=scene.get("image", "https://i.imgur.com/3Vk5Q7a.jpeg"),
             caption=f"**📖 {scene.get('title', 'Сюжет')}**\n\n{scene['text']}",
             parse_mode='Markdown',
-            reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+            reply_markup=build_markup((("➡️ Продолжить",), ("🏠 Вернуться в город",)))
         )
     elif scene_type == "battle":
         await update.message.reply_text(f"⚔️ **Сюжетный бой!**\n\n{scene['text']}", parse_mode='Markdown')
@@ -777,7 +1158,7 @@ async def handle_story_action(update, context, player, text):
     if text == "➡️ Продолжить":
         story_data = context.user_data.get('current_story', {})
         current_scene_id = story_data.get('current_scene')
-        scene = next((s for s in story_data['storyline'] if s["id"] == current_scene_id), None)
+        scene = get_story_scene(story_data.get('city'), current_scene_id)
         if scene and scene.get("next_scene"):
             player.story_progress[story_data['city']] = scene["next_scene"]
             await show_story_scene(update, context, player, story_data['city'], scene["next_scene"])
@@ -787,21 +1168,25 @@ async def start_random_event(update, context, player, city):
     context.user_data['in_random_event'] = False
     context.user_data['in_battle_from_event'] = False
     player.update_fatigue()
-    city_key = city.replace("_square", "").replace("_city", "")
-    small = RANDOM_EVENTS.get(f"{city_key}_small_events", [])
-    medium = RANDOM_EVENTS.get(f"{city_key}_medium_events", [])
-    all_events = small + medium
+    all_events = CITY_EVENTS.get(city, ())
 
     if not all_events:
         await update.message.reply_text("Здесь ничего не происходит.")
         return
 
-    available = [e for e in all_events if player.fatigue >= e.get("fatigue_cost", 0)]
-    if not available:
+    # Равновероятный выбор среди доступных событий за один проход, без промежуточного списка
+    event = None
+    fatigue = player.fatigue
+    k = 0
+    for e in all_events:
+        if fatigue >= e.get("fatigue_cost", 0):
+            k += 1
+            if _rand() * k < 1:
+                event = e
+    if event is None:
         await update.message.reply_text(f"❌ Вы слишком устали! ({int(player.fatigue)}/100). Отдохните.")
         return
 
-    event = random.choice(available)
     player.spend_fatigue(event.get("fatigue_cost", 0))
     await show_random_event(update, context, player, event)
 
@@ -815,13 +1200,13 @@ async def show_random_event(update, context, player, event):
         await continue_event_chain(update, context, player, "start")
     elif event["type"] == "reward":
         if "rewards" in event: await apply_rewards(update, player, event["rewards"])
-        kb = [[KeyboardButton("🎲 Еще событие")], [KeyboardButton("🏠 Вернуться в город")]]
-        await context.bot.send_photo(
+        await send_photo_cached(
+            context.bot,
             chat_id=update.effective_chat.id,
             photo=event.get("image", "https://i.imgur.com/9vOMVqL.png"),
             caption=f"**{event['name']}**\n\n{event['description']}\n\n{fatigue_txt}",
             parse_mode='Markdown',
-            reply_markup=ReplyKeyboardMarkup(kb, resize_keyboard=True)
+            reply_markup=EVENT_END_KB
         )
 
 async def continue_event_chain(update, context, player, text):
@@ -832,22 +1217,20 @@ async def continue_event_chain(update, context, player, text):
 
     if idx >= len(scenes):
         context.user_data['current_event_chain'] = None
-        kb = [[KeyboardButton("🎲 Еще событие")], [KeyboardButton("🏠 Вернуться в город")]]
-        await update.message.reply_text("Событие завершено.", reply_markup=ReplyKeyboardMarkup(kb, resize_keyboard=True))
+        await update.message.reply_text("Событие завершено.", reply_markup=EVENT_END_KB)
         return
 
     scene = scenes[idx]
     chain['index'] += 1
-    kb = []
-    if scene["type"] == "dialogue": kb.append([KeyboardButton("➡️ Продолжить")])
 
     if scene["type"] == "dialogue":
-        await context.bot.send_photo(
+        await send_photo_cached(
+            context.bot,
             chat_id=update.effective_chat.id,
             photo=scene.get("image", "https://i.imgur.com/9vOMVqL.png"),
             caption=scene["text"],
             parse_mode='Markdown',
-            reply_markup=ReplyKeyboardMarkup(kb, resize_keyboard=True)
+            reply_markup=build_markup((("➡️ Продолжить",),))
         )
     elif scene["type"] == "battle":
          await update.message.reply_text(f"⚔️ **Внезапная атака!**\n\n{scene['text']}", parse_mode='Markdown')
@@ -869,8 +1252,24 @@ async def handle_random_event_action(update, context, player, text):
         await start_random_event(update, context, player, player.current_city)
         return
 
+def level_up_cost(level, levels):
+    """Опыт на подъем с level на level + levels: 100 * (level + ... + level + levels - 1)"""
+    return 50 * levels * (2 * level + levels - 1)
+
+def levels_for_experience(level, experience):
+    """Сколько уровней подряд можно взять с этим опытом (решение квадратного неравенства)"""
+    b = 2 * level - 1
+    levels = max(0, int((math.sqrt(b * b + experience / 12.5) - b) / 2))
+    # Поправка на погрешность float
+    while level_up_cost(level, levels + 1) <= experience:
+        levels += 1
+    while levels and level_up_cost(level, levels) > experience:
+        levels -= 1
+    return levels
+
 async def apply_rewards(update, player, rewards):
-    if not rewards:
+    # Пустые награды ({}, нулевые опыт/золото, пустой список предметов) молча пропускаем
+    if not rewards or not any(rewards.values()):
         return
 
     reward_messages = []
@@ -882,25 +1281,33 @@ async def apply_rewards(update, player, rewards):
         player.experience += exp_gained
         reward_messages.append(f"📈 +{exp_gained} опыта")
 
-        # Проверяем повышение уровня
-        while player.experience >= player.level * 100:
-            player.experience -= player.level * 100
-            player.level += 1
-            player.base_stats['attack'] += 2
-            player.base_stats['health'] += 10
-
-            # Проверяем новые способности
+        # Проверяем повышение уровня (сразу на все уровни, которые позволяет опыт)
+        old_level = player.level
+        levels = levels_for_experience(old_level, player.experience)
+        if levels:
+            player.experience -= level_up_cost(old_level, levels)
+            player.level += levels
+            player.base_stats['attack'] += 2 * levels
+            player.base_stats['health'] += 10 * levels
+
+            # Проверяем новые способности на всех пройденных уровнях
+            new_abilities = []
             c_data = CLASSES.get(player.class_name)
-            if c_data and 'unlocks' in c_data:
-                new_skills = c_data['unlocks'].get(str(player.level))
-                if new_skills:
+            if c_data:
+                for lvl_req, new_skills in c_data['unlocks_sorted']:
+                    if lvl_req > player.level:
+                        break
+                    if lvl_req <= old_level:
+                        continue
                     for ability in new_skills:
                         if ability not in player.base_abilities:
                             player.base_abilities.append(ability)
-                            # Сохраняем способность в БД
-                            db.add_ability(player.user_id, ability)
+                            player.defer_write('ability', ability)
+                            new_abilities.append(ability)
 
-            reward_messages.append(f"🆙 Достигнут {player.level} уровень! (+10❤️, +2⚔️)")
+            reward_messages.append(f"🆙 Достигнут {player.level} уровень! (+{10 * levels}❤️, +{2 * levels}⚔️)")
+            if new_abilities:
+                reward_messages.append(f"✨ Новые способности: {', '.join(new_abilities)}")
 
     # Золото
     if "gold" in rewards:
@@ -912,12 +1319,9 @@ async def apply_rewards(update, player, rewards):
     if "items" in rewards:
         for item_id in rewards["items"]:
             if item_id in ITEMS:
-                player.inventory.append(item_id)
-                # Сохраняем предмет в БД
-                db.add_item(player.user_id, item_id)
+                player.add_item(item_id)
 
-                item_name = ITEMS[item_id]['name']
-                reward_items.append(item_name)
+                reward_items.append(ITEMS[item_id]['name_md'])
 
     # Кристаллы (если будет донат система)
     if "crystals" in rewards:
@@ -931,7 +1335,7 @@ async def apply_rewards(update, player, rewards):
         message = "🎁 **Получено:**\n"
 
         if reward_messages:
-            message += "\n".join([f"• {msg}" for msg in reward_messages])
+            message += "\n".join(f"• {msg}" for msg in reward_messages)
 
         if reward_items:
             if reward_messages:
@@ -941,10 +1345,26 @@ async def apply_rewards(update, player, rewards):
         await update.message.reply_text(message, parse_mode='Markdown')
 
         # Сохраняем изменения в БД
-        player.save(force=True)
+        player.mark_dirty()
+        await flush_player_writes(player)
     else:
         await update.message.reply_text("ℹ️ Награды не получены.")
 
+@dataclass(slots=True)
+class BattleState:
+    """Состояние текущего боя игрока (хранится в user_data['battle'])"""
+    enemy: dict
+    e_hp: int
+    p_hp: int
+    e_id: str
+    res_mult: dict
+    kb: ReplyKeyboardMarkup
+    stats: dict  # snapshot of player.get_total_stats(); None after a buff, rebuilt next turn
+    max_hp: int  # level can't change mid-battle
+    phase: int = 1
+    skill_uses: dict = field(default_factory=dict)
+    active_dots: list = field(default_factory=list) # List of active DoTs on enemy
+
 async def start_battle(update, context, player, enemy_id):
     enemy = ENEMIES.get(enemy_id) or BOSSES.get(enemy_id)
     if not enemy: return
@@ -952,19 +1372,16 @@ async def start_battle(update, context, player, enemy_id):
     stats = player.get_total_stats()
 
     # Init counters for skills and DoTs
-    context.user_data['battle'] = {
-        'enemy': enemy.copy(),
-        'e_hp': enemy['health'],
-        'p_hp': stats['health'],
-        'e_id': enemy_id,
-        'phase': 1,
-        'skill_uses': {},
-        'active_dots': [] # List of active DoTs on enemy
-    }
-
-    abilities = player.get_all_abilities()
-    buttons = [KeyboardButton("⚔️ Атака")] + [KeyboardButton(f"🔮 {a}") for a in abilities] + [KeyboardButton("🧪 Зелья"), KeyboardButton("🏃 Бежать")]
-    layout = get_keyboard_layout(buttons, 2)
+    context.user_data['battle'] = BattleState(
+        enemy=enemy.copy(),
+        e_hp=enemy['health'],
+        p_hp=stats['health'],
+        e_id=enemy_id,
+        res_mult=resistance_multipliers(enemy.get('resistances', {})),
+        kb=build_battle_markup(player), # Abilities don't change mid-battle
+        stats=stats,
+        max_hp=player.get_max_health()
+    )
 
     buff_txt = ""
     if player.active_effects:
@@ -982,51 +1399,57 @@ async def start_battle(update, context, player, enemy_id):
              r_list.append(f"{icon} {pct}%")
         if r_list: resist_txt = "\n🛡️ Резисты: " + ", ".join(r_list)
 
-    await context.bot.send_photo(
+    await send_photo_cached(
+        context.bot,
         chat_id=update.effective_chat.id,
         photo=enemy['image'],
         caption=f"⚔️ **Бой с {enemy['name']}!**\nHP: {enemy['health']} | ATK: {enemy['attack']}{buff_txt}{resist_txt}",
         parse_mode='Markdown',
-        reply_markup=ReplyKeyboardMarkup(layout, resize_keyboard=True)
+        reply_markup=context.user_data['battle'].kb
     )
 
+def build_battle_markup(player):
+    """Клавиатура боя: атака, способности игрока, зелья и побег"""
+    abilities = player.get_all_abilities()
+    return labels_markup(["⚔️ Атака"] + [f"🔮 {a}" for a in abilities] + ["🧪 Зелья", "🏃 Бежать"], 2)
+
 async def handle_battle(update, context, player, text):
     b = context.user_data['battle']
-    enemy = b['enemy']
-    stats = player.get_total_stats()
+    enemy = b.enemy
+    if b.stats is None:
+        b.stats = player.get_total_stats()
+    stats = b.stats
     turn_ended = False
 
     # --- Potion Logic (Unchanged) ---
     if context.user_data.get('battle_potion_menu'):
         if text == "⬅️ Назад":
             del context.user_data['battle_potion_menu']
-            abilities = player.get_all_abilities()
-            buttons = [KeyboardButton("⚔️ Атака")] + [KeyboardButton(f"🔮 {a}") for a in abilities] + [KeyboardButton("🧪 Зелья"), KeyboardButton("🏃 Бежать")]
-            layout = get_keyboard_layout(buttons, 2)
-            await update.message.reply_text("⚔️ Бой продолжается!", reply_markup=ReplyKeyboardMarkup(layout, resize_keyboard=True))
+            await update.message.reply_text("⚔️ Бой продолжается!", reply_markup=b.kb)
             return
         if "🍺 " in text:
             try:
                 p_name = text.split("🍺 ")[1].rsplit(" (", 1)[0]
-                item_id = next((k for k,v in ITEMS.items() if v['name'] == p_name), None)
+                item_id = ITEMS_BY_NAME.get(p_name)
                 if item_id and item_id in player.inventory:
                     item = ITEMS[item_id]
                     heal = item.get('stats', {}).get('health', 0)
                     buffs = item.get('buffs', {})
-                    max_hp = player.get_max_health()
-                    if heal > 0 and not buffs and b['p_hp'] >= max_hp:
+                    max_hp = b.max_hp
+                    if heal > 0 and not buffs and b.p_hp >= max_hp:
                         await update.message.reply_text("❤️ Здоровье и так полное!")
                         return
-                    player.inventory.remove(item_id)
+                    player.remove_item(item_id)
                     msg = f"🧪 Вы выпили {p_name}."
                     if heal > 0:
-                        b['p_hp'] = min(max_hp, b['p_hp'] + heal)
-                        player.base_stats['health'] = b['p_hp']
-                        msg += f" HP +{heal}. Здоровье: {b['p_hp']}"
+                        b.p_hp = min(max_hp, b.p_hp + heal)
+                        player.base_stats['health'] = b.p_hp
+                        msg += f" HP +{heal}. Здоровье: {b.p_hp}"
                     if buffs:
                         buff_stats = {k: v for k, v in buffs.items() if k != 'duration'}
                         duration = buffs.get('duration', 1)
                         player.add_effect(item['name'], buff_stats, duration)
+                        b.stats = None
                         msg += f"\n💪 Эффект наложен на {duration} боев!"
                         for stat, val in buff_stats.items():
                             msg += f"\n+ {stat.upper()} +{val}"
@@ -1041,19 +1464,14 @@ async def handle_battle(update, context, player, text):
                 return
         else: return
     elif text == "🧪 Зелья":
-         potions = [i for i in player.inventory if ITEMS.get(i, {}).get('type') == 'consumable']
+         potions = {i: n for i, n in player.inventory.items() if ITEMS.get(i, {}).get('type') == 'consumable'}
          if not potions:
              await update.message.reply_text("У вас нет зелий!")
              return
-         buttons = []
-         for pid in set(potions):
-             item = ITEMS[pid]
-             count = potions.count(pid)
-             buttons.append(KeyboardButton(f"🍺 {item['name']} ({count})"))
-         buttons.append(KeyboardButton("⬅️ Назад"))
-         layout = get_keyboard_layout(buttons, 1)
+         labels = [f"🍺 {ITEMS[pid]['name']} ({count})" for pid, count in potions.items()]
+         labels.append("⬅️ Назад")
          context.user_data['battle_potion_menu'] = True
-         await update.message.reply_text("Выберите зелье:", reply_markup=ReplyKeyboardMarkup(layout, resize_keyboard=True))
+         await update.message.reply_text("Выберите зелье:", reply_markup=labels_markup(labels, 1))
          return
     elif text == "🏃 Бежать":
         context.user_data['in_battle'] = False
@@ -1064,16 +1482,19 @@ async def handle_battle(update, context, player, text):
         await show_location(update, context, player, player.current_city)
         return
 
+    # Whole turn (attack, DoT ticks, enemy reply) is sent as one Markdown message
+    turn_lines = []
+
     # --- Player Turn ---
     if not context.user_data.get('battle_potion_menu') and not turn_ended:
         desc = ""
         total_dmg = 0
-        enemy_res = enemy.get('resistances', {})
+        res_mult = b.res_mult
 
         # Standard Attack
         if text == "⚔️ Атака":
-            dmg = calculate_single_layer_damage(stats['attack'], 1.0, "physical", enemy_res)
-            b['e_hp'] -= dmg
+            dmg = calculate_single_layer_damage(stats['attack'], 1.0, "physical", res_mult)
+            b.e_hp -= dmg
             desc = f"{DAMAGE_ICONS['physical']} Вы ударили {enemy['name']} и нанесли {dmg} физ. урона."
 
         # Special Abilities
@@ -1083,28 +1504,28 @@ async def handle_battle(update, context, player, text):
 
             if effect:
                 # Check limits
-                uses = b['skill_uses'].get(ability_name, 0)
+                uses = b.skill_uses.get(ability_name, 0)
                 limit = effect.get('max_uses', 99)
                 if uses >= limit:
                     await update.message.reply_text(f"❌ Способность {ability_name} исчерпана ({limit}/{limit})!")
                     return
 
-                b['skill_uses'][ability_name] = uses + 1
+                b.skill_uses[ability_name] = uses + 1
 
                 # Calculate Layers
                 layers_txt = []
                 total_ability_dmg = 0
 
                 if "layers" in effect:
-                    for layer in effect["layers"]:
-                        l_dmg = calculate_single_layer_damage(stats['attack'], layer["mult"], layer["type"], enemy_res)
+                    layer_dmgs = calculate_damage_batch(stats['attack'], effect["layers"], res_mult)
+                    for layer, l_dmg in zip(effect["layers"], layer_dmgs):
                         total_ability_dmg += l_dmg
                         layers_txt.append(f"{l_dmg} {DAMAGE_ICONS.get(layer['type'], '')}")
                 elif "dmg_mult" in effect: # Backwards compatibility
-                    total_ability_dmg = calculate_single_layer_damage(stats['attack'], effect["dmg_mult"], "physical", enemy_res)
+                    total_ability_dmg = calculate_single_layer_damage(stats['attack'], effect["dmg_mult"], "physical", res_mult)
                     layers_txt.append(f"{total_ability_dmg} {DAMAGE_ICONS['physical']}")
 
-                b['e_hp'] -= total_ability_dmg
+                b.e_hp -= total_ability_dmg
                 desc = f"✨ **{ability_name}** ({uses+1}/{limit}):\nУрон: {' + '.join(layers_txt)}"
 
                 # Apply DoT
@@ -1114,18 +1535,17 @@ async def handle_battle(update, context, player, text):
                     # Let's apply resistance to the DoT value now so it ticks for the correct amount.
                     dot_raw = stats['attack'] * dot_conf["mult"]
                     # Usually DoTs match the damage type of the spell, or specific poison type.
-                    dot_res_val = enemy_res.get(dot_conf["type"], 0.0)
-                    dot_dmg = int(dot_raw * max(0.0, 1.0 - dot_res_val))
+                    dot_dmg = int(dot_raw * res_mult.get(dot_conf["type"], 1.0))
 
                     # Check if DoT exists to refresh instead of stack
-                    existing = next((d for d in b['active_dots'] if d['name'] == dot_conf['name']), None)
+                    existing = next((d for d in b.active_dots if d['name'] == dot_conf['name']), None)
 
                     if existing:
                         existing['duration'] = dot_conf['duration']
                         existing['damage'] = max(1, dot_dmg) # Update dmg based on current stats
                         desc += f"\n🔄 {dot_conf['name']} обновлено ({dot_conf['duration']} ход.)"
                     else:
-                        b['active_dots'].append({
+                        b.active_dots.append({
                             "type": dot_conf["type"],
                             "name": dot_conf["name"],
                             "damage": max(1, dot_dmg),
@@ -1136,61 +1556,71 @@ async def handle_battle(update, context, player, text):
                 # Apply Heals
                 if "heal" in effect:
                     healed = int(total_ability_dmg * effect["heal"])
-                    b['p_hp'] += healed
+                    b.p_hp += healed
                     desc += f"\n💚 Лечение: +{healed}"
                 if "heal_flat" in effect:
-                    b['p_hp'] += effect["heal_flat"]
+                    b.p_hp += effect["heal_flat"]
                     desc += f"\n💚 Лечение: +{effect['heal_flat']}"
 
                 # Defense Buff
                 if "defense_buff" in effect:
                      player.add_effect(ability_name, {"defense": effect["defense_buff"]}, 1)
+                     b.stats = None
                      desc += f"\n🛡️ Защита +{effect['defense_buff']} на 1 ход."
 
-        await update.message.reply_text(desc, parse_mode='Markdown')
+        if desc:
+            turn_lines.append(desc)
 
-        if b['e_hp'] <= 0:
+        if b.e_hp <= 0:
+            if turn_lines:
+                await update.message.reply_text("\n".join(turn_lines), parse_mode='Markdown')
             await handle_enemy_death(update, context, player, b)
             return
 
     # --- DoT Phase (Enemy takes damage) ---
     dot_log = []
     active_dots_new = []
-    for dot in b['active_dots']:
-        b['e_hp'] -= dot['damage']
-        dot_log.append(f"{DAMAGE_ICONS.get(dot['type'], '')} {dot['name']}: {dot['damage']}")
+    for dot in b.active_dots:
+        b.e_hp -= dot['damage']
+        # Ход уходит одним сообщением с Markdown: имена экранируем, чтобы '_' или '*' не сломали разметку
+        dot_log.append(f"{DAMAGE_ICONS.get(dot['type'], '')} {escape_markdown(dot['name'])}: {dot['damage']}")
         dot['duration'] -= 1
         if dot['duration'] > 0:
             active_dots_new.append(dot)
 
-    b['active_dots'] = active_dots_new
+    b.active_dots = active_dots_new
 
     if dot_log:
-        await update.message.reply_text("💀 Периодический урон:\n" + "\n".join(dot_log))
-        if b['e_hp'] <= 0:
-             await handle_enemy_death(update, context, player, b)
-             return
+        if turn_lines:
+            turn_lines.append("")
+        turn_lines += ["💀 Периодический урон:", *dot_log]
+        if b.e_hp <= 0:
+            await update.message.reply_text("\n".join(turn_lines), parse_mode='Markdown')
+            await handle_enemy_death(update, context, player, b)
+            return
 
     # --- Enemy Turn ---
     e_base_dmg = max(1, enemy['attack'] - stats['defense'])
     e_dmg = int(e_base_dmg * random.uniform(0.9, 1.1))
-    b['p_hp'] -= e_dmg
+    b.p_hp -= e_dmg
 
-    status = f"{enemy['name']} бьет в ответ! Урон: {e_dmg}.\n\n❤️ Ваш HP: {b['p_hp']}\n💀 Враг HP: {b['e_hp']}"
-    abilities = player.get_all_abilities()
-    buttons = [KeyboardButton("⚔️ Атака")] + [KeyboardButton(f"🔮 {a}") for a in abilities] + [KeyboardButton("🧪 Зелья"), KeyboardButton("🏃 Бежать")]
-    layout = get_keyboard_layout(buttons, 2)
-    await update.message.reply_text(status, reply_markup=ReplyKeyboardMarkup(layout, resize_keyboard=True))
+    status = f"{escape_markdown(enemy['name'])} бьет в ответ! Урон: {e_dmg}.\n\n❤️ Ваш HP: {b.p_hp}\n💀 Враг HP: {b.e_hp}"
+    if turn_lines:
+        turn_lines.append("")
+    turn_lines.append(status)
+    await update.message.reply_text("\n".join(turn_lines), parse_mode='Markdown', reply_markup=b.kb)
 
-    if b['p_hp'] <= 0: await lose_battle(update, context, player)
-    else: player.base_stats['health'] = b['p_hp']
+    if b.p_hp <= 0: await lose_battle(update, context, player)
+    else:
+        player.base_stats['health'] = b.p_hp
+        player.mark_dirty()
 
 async def handle_enemy_death(update, context, player, battle_data):
-    enemy = battle_data['enemy']
-    if "phases" in enemy and battle_data['phase'] <= len(enemy["phases"]):
-        phase_data = enemy["phases"][battle_data['phase'] - 1]
-        battle_data['phase'] += 1
-        battle_data['e_hp'] = phase_data['health']
+    enemy = battle_data.enemy
+    if "phases" in enemy and battle_data.phase <= len(enemy["phases"]):
+        phase_data = enemy["phases"][battle_data.phase - 1]
+        battle_data.phase += 1
+        battle_data.e_hp = phase_data['health']
         enemy['attack'] = phase_data['attack']
         enemy['name'] = phase_data['name']
         enemy['image'] = phase_data['image']
@@ -1198,15 +1628,17 @@ async def handle_enemy_death(update, context, player, battle_data):
         # Load Phase resistances if exist
         if "resistances" in phase_data:
             enemy['resistances'] = phase_data['resistances']
+            battle_data.res_mult = resistance_multipliers(enemy['resistances'])
 
-        await context.bot.send_photo(
+        await send_photo_cached(
+            context.bot,
             chat_id=update.effective_chat.id,
             photo=enemy['image'],
-            caption=f"⚠️ **{enemy['name']} ВОЗРОЖДАЕТСЯ!** (Фаза {battle_data['phase']})\n\n{phase_data.get('message', 'Враг стал сильнее!')}\nHP: {battle_data['e_hp']} | ATK: {enemy['attack']}",
+            caption=f"⚠️ **{enemy['name']} ВОЗРОЖДАЕТСЯ!** (Фаза {battle_data.phase})\n\n{phase_data.get('message', 'Враг стал сильнее!')}\nHP: {battle_data.e_hp} | ATK: {enemy['attack']}",
             parse_mode='Markdown'
         )
         return
-    await win_battle(update, context, player, battle_data['enemy'], battle_data['e_id'])
+    await win_battle(update, context, player, battle_data.enemy, battle_data.e_id)
 
 async def win_battle(update, context, player, enemy, enemy_id):
     context.user_data['in_battle'] = False
@@ -1227,58 +1659,38 @@ async def win_battle(update, context, player, enemy, enemy_id):
     rewards = {'experience': enemy['experience'], 'gold': int(enemy['experience'] * 0.8)}
 
     if enemy.get('is_boss'):
-        player.defeated_bosses.add(enemy_id)
+        player.defeated_bosses_mask |= BOSS_BIT.get(enemy_id, 0)
         player.artifact_slots += 1
         rewards['gold'] += 100
 
-        # Сохраняем победу над боссом в БД
-        db.add_defeated_boss(player.user_id, enemy_id)
+        player.defer_write('boss', enemy_id)
 
-        await update.message.reply_text(f"🏆 **БОСС ПОВЕРЖЕН!** Слот под артефакт открыт!{status_msg}")
+        win_msg = f"🏆 **БОСС ПОВЕРЖЕН!** Слот под артефакт открыт!{status_msg}"
     else:
-        await update.message.reply_text(f"⚔️ **Победа!**{status_msg}")
+        win_msg = f"⚔️ **Победа!**{status_msg}"
 
-    # Сохраняем убийство в БД
-    db.add_kill(player.user_id, enemy_id)
+    player.defer_write('kill', enemy_id)
     player.kill_count[enemy_id] = player.kill_count.get(enemy_id, 0) + 1
 
-    # Проверяем завершение квестов
-    for q_id in player.active_quests[:]:
-        quest = QUESTS.get(q_id)
-        if quest and all(player.kill_count.get(mob, 0) >= count for mob, count in quest.get('objectives', {}).items()):
+    # Проверяем завершение квестов, в целях которых есть этот враг
+    # (сообщения о них идут вместе с сообщением о победе)
+    done_quests = []
+    for q_id in QUESTS_BY_MOB.get(enemy_id, ()):
+        if q_id not in player.active_quests:
+            continue
+        quest = QUESTS[q_id]
+        if all(player.kill_count.get(mob, 0) >= count for mob, count in quest.get('objectives', {}).items()):
             player.active_quests.remove(q_id)
             player.completed_quests.append(q_id)
 
-            # Обновляем квесты в БД
-            db.complete_quest(player.user_id, q_id)
-
-            await update.message.reply_text(f"✅ **Квест '{quest['name']}' выполнен!**")
-            await apply_rewards(update, player, quest['rewards'])
+            player.defer_write('quest_done', q_id)
 
-    # Проверяем повышение уровня
-    if player.experience >= player.level * 100:
-        player.experience -= player.level * 100
-        player.level += 1
-        player.base_stats['attack'] += 2
-        player.base_stats['health'] += 10
+            win_msg += f"\n✅ **Квест '{quest['name']}' выполнен!**"
+            done_quests.append(quest)
 
-        # Обновляем уровень в БД
-        player.save(force=True)
-
-        await update.message.reply_text(f"🆙 **Уровень {player.level}!**\n❤️+10, ⚔️+2")
-
-        # Check for new ability unlock immediately
-        c_data = CLASSES.get(player.class_name)
-        if c_data and 'unlocks' in c_data:
-            new_skills = c_data['unlocks'].get(str(player.level))
-            if new_skills:
-                # Сохраняем новые способности в БД
-                for ability in new_skills:
-                    db.add_ability(player.user_id, ability)
-                    if ability not in player.base_abilities:
-                        player.base_abilities.append(ability)
-
-                await update.message.reply_text(f"✨ **Новая способность разблокирована:** {', '.join(new_skills)}!")
+    await update.message.reply_text(win_msg)
+    for quest in done_quests:
+        await apply_rewards(update, player, quest['rewards'])
 
     if is_event_battle:
         context.user_data['in_battle_from_event'] = False
@@ -1287,11 +1699,10 @@ async def win_battle(update, context, player, enemy, enemy_id):
     elif context.user_data.get('in_story'):
         await apply_rewards(update, player, rewards)
         story_data = context.user_data.get('current_story', {})
-        current_scene = next((s for s in story_data['storyline'] if s["id"] == story_data['current_scene']), None)
+        current_scene = get_story_scene(story_data.get('city'), story_data.get('current_scene'))
         if current_scene and current_scene.get("next_scene"):
              player.story_progress[story_data['city']] = current_scene["next_scene"]
-             # Сохраняем прогресс сюжета в БД
-             db.update_story_progress(player.user_id, story_data['city'], current_scene["next_scene"])
+             player.defer_write('story', story_data['city'], current_scene["next_scene"])
              await show_story_scene(update, context, player, story_data['city'], current_scene["next_scene"])
         else:
              context.user_data['in_story'] = False
@@ -1300,8 +1711,9 @@ async def win_battle(update, context, player, enemy, enemy_id):
         await apply_rewards(update, player, rewards)
         await show_location(update, context, player, player.location)
 
-    # Финальное сохранение игрока
-    player.save(force=True)
+    # Финальное сохранение игрока: все отложенные операции боя одной транзакцией
+    await flush_player_writes(player)
+    await db_async.save_player(player, force=True)
 
 async def lose_battle(update: Update, context: ContextTypes.DEFAULT_TYPE, player):
     last_location_before_battle = player.last_location if player.last_location in LOCATIONS else "village_square"
@@ -1318,6 +1730,7 @@ async def lose_battle(update: Update, context: ContextTypes.DEFAULT_TYPE, player
 
     if player.active_effects:
         player.active_effects = []
+        player.invalidate_stats()
         await update.message.reply_text("☠️ Эффекты всех зелий рассеялись.")
 
     player.base_stats['health'] = CLASSES[player.class_name]['base_stats']['health'] + (player.level - 1) * 10
@@ -1328,8 +1741,11 @@ async def lose_battle(update: Update, context: ContextTypes.DEFAULT_TYPE, player
         "image": "https://i.imgur.com/6ZJZT8q.jpeg"
     })
     player.location = "player_camp"
+    player.camp_entry_time = time.time()
+    player.mark_dirty()
 
-    await context.bot.send_photo(
+    await send_photo_cached(
+        context.bot,
         chat_id=update.effective_chat.id,
         photo=location["image"],
         caption=f"**{location['name']}**\n\n{location['description']}\n⏳ _Отдых 15 секунд..._",
@@ -1337,13 +1753,27 @@ async def lose_battle(update: Update, context: ContextTypes.DEFAULT_TYPE, player
         reply_markup=ReplyKeyboardRemove()
     )
 
-    await asyncio.sleep(15)
+    # Возвращение по таймеру JobQueue: обработчик не висит 15 секунд вместе с update
+    context.job_queue.run_once(
+        respawn_player,
+        RESPAWN_DELAY,
+        data={'return_loc': last_location_before_battle},
+        chat_id=update.effective_chat.id,
+        user_id=player.user_id,
+        name=f"respawn_{player.user_id}"
+    )
 
+async def respawn_player(context: ContextTypes.DEFAULT_TYPE):
+    """Задача JobQueue: выводит игрока из лагеря после отдыха"""
+    job = context.job
+    player = await aget_player(job.user_id)
+    if player.location != "player_camp":
+        return
     await context.bot.send_message(
-        chat_id=update.effective_chat.id,
-        text="⏰ 15 секунд прошло! Возвращаемся к приключениям..."
+        chat_id=job.chat_id,
+        text=f"⏰ {RESPAWN_DELAY} секунд прошло! Возвращаемся к приключениям..."
     )
-    await show_location(update, context, player, last_location_before_battle)
+    await show_location(None, context, player, job.data['return_loc'], chat_id=job.chat_id)
 
 # --- INVENTORY & ITEMS ---
 
@@ -1352,16 +1782,14 @@ async def show_inventory_menu(update, context, player):
     context.user_data['viewing_item'] = None
     msg = f"🎒 **Инвентарь**\n💰 {player.gold}\n📦 Артефакты: {len(player.equipped_artifacts)}/{player.artifact_slots}\n\n"
     if not player.inventory: msg += "Пусто."
-    item_counts = {i: player.inventory.count(i) for i in set(player.inventory)}
-    buttons = []
-    for item_id, count in item_counts.items():
+    labels = []
+    for item_id, count in player.inventory.items():
         item = ITEMS.get(item_id)
         if item:
             status = " (E)" if item_id in player.equipped_artifacts else ""
-            buttons.append(KeyboardButton(f"{item['name']} x{count}{status}"))
-    buttons.append(KeyboardButton("⬅️ Назад"))
-    layout = get_keyboard_layout(buttons, 2)
-    await update.message.reply_text(msg, parse_mode='Markdown', reply_markup=ReplyKeyboardMarkup(layout, resize_keyboard=True))
+            labels.append(f"{item['name']} x{count}{status}")
+    labels.append("⬅️ Назад")
+    await update.message.reply_text(msg, parse_mode='Markdown', reply_markup=labels_markup(labels, 2))
 
 async def handle_inventory_action(update, context, player, text):
     if text == "⬅️ Назад":
@@ -1369,11 +1797,11 @@ async def handle_inventory_action(update, context, player, text):
         else: await show_location(update, context, player, player.location)
         return
     if not context.user_data.get('viewing_item'):
-        for item_id in set(player.inventory):
+        for item_id, count in player.inventory.items():
             item = ITEMS.get(item_id)
             if item:
                 status = " (E)" if item_id in player.equipped_artifacts else ""
-                if text == f"{item['name']} x{player.inventory.count(item_id)}{status}":
+                if text == f"{item['name']} x{count}{status}":
                     await show_item_details(update, context, player, item_id)
                     return
     item_id = context.user_data.get('viewing_item')
@@ -1381,7 +1809,7 @@ async def handle_inventory_action(update, context, player, text):
         item = ITEMS.get(item_id)
         if text == "🖐 Использовать" and item:
             if item['type'] == 'consumable':
-                player.inventory.remove(item_id)
+                player.remove_item(item_id)
                 if 'stats' in item and 'health' in item['stats']:
                     heal = item['stats']['health']
                     player.base_stats['health'] = min(player.get_max_health(), player.base_stats['health'] + heal)
@@ -1404,20 +1832,19 @@ async def handle_inventory_action(update, context, player, text):
 async def show_item_details(update, context, player, item_id):
     context.user_data['viewing_item'] = item_id
     item = ITEMS[item_id]
-    desc = f"**{item['name']}**\n{item['description']}"
+    desc = f"**{item['name_md']}**\n{item['description']}"
     if 'stats' in item: desc += "\n" + ", ".join([f"{k.upper()}: {v}" for k,v in item['stats'].items()])
     if 'buffs' in item:
         dur = item['buffs'].get('duration', 1)
         desc += f"\n⏳ Длительность: {dur} боев"
 
-    buttons = []
-    if item['type'] == 'consumable': buttons.append(KeyboardButton("🖐 Использовать"))
+    labels = []
+    if item['type'] == 'consumable': labels.append("🖐 Использовать")
     elif item['type'] == 'artifact':
-        if item_id in player.equipped_artifacts: buttons.append(KeyboardButton("🔻 Снять"))
-        else: buttons.append(KeyboardButton("🛡️ Надеть"))
-    buttons.append(KeyboardButton("⬅️ Назад"))
-    layout = get_keyboard_layout(buttons, 2)
-    await update.message.reply_text(desc, parse_mode='Markdown', reply_markup=ReplyKeyboardMarkup(layout, resize_keyboard=True))
+        if item_id in player.equipped_artifacts: labels.append("🔻 Снять")
+        else: labels.append("🛡️ Надеть")
+    labels.append("⬅️ Назад")
+    await update.message.reply_text(desc, parse_mode='Markdown', reply_markup=labels_markup(labels, 2))
 
 # --- SHOP SYSTEM (CONFIRMATION ADDED) ---
 
@@ -1426,51 +1853,52 @@ async def start_shop(update, context, player, shop_items):
     context.user_data['current_shop_items'] = shop_items
     await show_shop_menu(update, context, player, shop_items)
 
-async def show_shop_menu(update, context, player, items):
-    msg = f"🏪 **Магазин**\n💰 {player.gold}\n_Нажмите на предмет, чтобы увидеть описание и купить._"
-    buttons = []
+@lru_cache(maxsize=256)
+def _build_shop_markup(items):
+    """Клавиатура магазина и словарь подпись -> item_id. Результат общий, не изменять"""
+    # Подпись кнопки -> item_id: нажатие находится одним обращением к словарю
+    buy_labels = {}
     for item_id in items:
         item = ITEMS.get(item_id)
-        if item: buttons.append(KeyboardButton(f"{item['name']} ({item['price']}💰)"))
-    buttons.append(KeyboardButton("💰 Продать предметы"))
-    buttons.append(KeyboardButton("⬅️ Назад"))
-    layout = get_keyboard_layout(buttons, 1)
-    await update.message.reply_text(msg, parse_mode='Markdown', reply_markup=ReplyKeyboardMarkup(layout, resize_keyboard=True))
+        if item:
+            buy_labels[item['buy_label']] = item_id
+    labels = list(buy_labels) + ["💰 Продать предметы", "⬅️ Назад"]
+    return labels_markup(labels, 1), buy_labels
+
+async def show_shop_menu(update, context, player, items):
+    msg = f"🏪 **Магазин**\n💰 {player.gold}\n_Нажмите на предмет, чтобы увидеть описание и купить._"
+    markup, context.user_data['buy_labels'] = _build_shop_markup(tuple(items))
+    await update.message.reply_text(msg, parse_mode='Markdown', reply_markup=markup)
 
 async def show_shop_item_details(update, context, player, item_id, is_selling=False):
     item = ITEMS[item_id]
-    desc = f"**{item['name']}**\n{item['description']}"
+    desc = f"**{item['name_md']}**\n{item['description']}"
     if 'stats' in item: desc += "\n" + ", ".join([f"{k.upper()}: {v}" for k,v in item['stats'].items()])
 
     if is_selling:
-        sell_price = max(1, int(item['price'] * 0.5))
-        desc += f"\n\n💰 Цена продажи: {sell_price}"
-        buttons = [[KeyboardButton("✅ Подтвердить продажу")], [KeyboardButton("⬅️ Назад")]]
+        desc += f"\n\n💰 Цена продажи: {item['sell_price']}"
+        markup = CONFIRM_SELL_KB
         context.user_data['shop_confirm_sell'] = item_id
     else:
         desc += f"\n\n💰 Цена: {item['price']}"
-        buttons = [[KeyboardButton("✅ Подтвердить покупку")], [KeyboardButton("⬅️ Назад")]]
+        markup = CONFIRM_BUY_KB
         context.user_data['shop_confirm_buy'] = item_id
 
-    await update.message.reply_text(desc, parse_mode='Markdown', reply_markup=ReplyKeyboardMarkup(buttons, resize_keyboard=True))
+    await update.message.reply_text(desc, parse_mode='Markdown', reply_markup=markup)
 
 async def show_sell_menu(update, context, player):
     context.user_data['in_shop_sell'] = True
     msg = f"💰 **Скупка краденого**\nЯ куплю твои вещи за полцены.\nУ тебя: {player.gold}💰\n_Нажмите, чтобы увидеть детали._"
-    buttons = []
-    seen = set()
-    for item_id in player.inventory:
-        if item_id in seen: continue
+    sell_labels = {}
+    for item_id, count in player.inventory.items():
         if item_id in player.equipped_artifacts: continue
         item = ITEMS.get(item_id)
         if item:
-            seen.add(item_id)
-            count = player.inventory.count(item_id)
-            sell_price = max(1, int(item['price'] * 0.5))
-            buttons.append(KeyboardButton(f"{item['name']} ({sell_price}💰) x{count}"))
-    buttons.append(KeyboardButton("⬅️ Назад"))
-    layout = get_keyboard_layout(buttons, 1)
-    await update.message.reply_text(msg, parse_mode='Markdown', reply_markup=ReplyKeyboardMarkup(layout, resize_keyboard=True))
+            sell_labels[f"{item['sell_label']} x{count}"] = item_id
+    context.user_data['sell_labels'] = sell_labels
+    # Подписи зависят от количества предметов, но одинаковые наборы берутся из кэша build_markup
+    markup = labels_markup(list(sell_labels) + ["⬅️ Назад"], 1)
+    await update.message.reply_text(msg, parse_mode='Markdown', reply_markup=markup)
 
 async def handle_shop_action(update, context, player, text):
     if text == "⬅️ Назад":
@@ -1497,7 +1925,7 @@ async def handle_shop_action(update, context, player, text):
             item = ITEMS[item_id]
             if player.gold >= item['price']:
                 player.gold -= item['price']
-                player.inventory.append(item_id)
+                player.add_item(item_id)
                 await update.message.reply_text(f"✅ Вы купили: {item['name']}")
                 context.user_data['shop_confirm_buy'] = None
                 await show_shop_menu(update, context, player, context.user_data.get('current_shop_items', []))
@@ -1510,9 +1938,9 @@ async def handle_shop_action(update, context, player, text):
         if text == "✅ Подтвердить продажу":
             item_id = context.user_data['shop_confirm_sell']
             item = ITEMS[item_id]
-            sell_price = max(1, int(item['price'] * 0.5))
+            sell_price = item['sell_price']
             if item_id in player.inventory:
-                player.inventory.remove(item_id)
+                player.remove_item(item_id)
                 player.gold += sell_price
                 await update.message.reply_text(f"✅ Вы продали {item['name']} за {sell_price}💰")
                 context.user_data['shop_confirm_sell'] = None
@@ -1528,33 +1956,29 @@ async def handle_shop_action(update, context, player, text):
 
     # Check clicked items in Sell Menu
     if context.user_data.get('in_shop_sell'):
-        for item_id in set(player.inventory):
-            item = ITEMS.get(item_id)
-            if not item: continue
-            sell_price = max(1, int(item['price'] * 0.5))
-            count = player.inventory.count(item_id)
-            if text == f"{item['name']} ({sell_price}💰) x{count}":
-                await show_shop_item_details(update, context, player, item_id, is_selling=True)
-                return
+        item_id = context.user_data.get('sell_labels', {}).get(text)
+        if item_id and item_id in player.inventory:
+            await show_shop_item_details(update, context, player, item_id, is_selling=True)
+            return
     else:
         # Check clicked items in Buy Menu
-        shop_items = context.user_data.get('current_shop_items', [])
-        selected = next((iid for iid in shop_items if ITEMS.get(iid) and text.startswith(ITEMS[iid]['name'])), None)
+        selected = context.user_data.get('buy_labels', {}).get(text)
         if selected:
              await show_shop_item_details(update, context, player, selected, is_selling=False)
 
 # --- TELEPORT & STATS (UNCHANGED) ---
 
+@lru_cache(maxsize=256)
+def _build_teleport_markup(unlocked_mask, current_city):
+    """Клавиатура телепортации по маске открытых городов (без текущего)"""
+    labels = [f"📍 {LOCATIONS[city_id]['name']}" for city_id in from_mask(unlocked_mask, LOC_BIT) if city_id != current_city]
+    labels.append("⬅️ Назад")
+    return labels_markup(labels, 2)
+
 async def show_city_teleport_menu(update, context, player):
     context.user_data['in_city_teleport'] = True
-    buttons = []
-    for city_id in player.unlocked_cities:
-        if city_id != player.current_city:
-            city_name = LOCATIONS[city_id]['name']
-            buttons.append(KeyboardButton(f"📍 {city_name}"))
-    buttons.append(KeyboardButton("⬅️ Назад"))
-    layout = get_keyboard_layout(buttons, 2)
-    await update.message.reply_text("🚀 **Телепортация**\nВыберите город:", parse_mode='Markdown', reply_markup=ReplyKeyboardMarkup(layout, resize_keyboard=True))
+    markup = _build_teleport_markup(player.unlocked_mask, player.current_city)
+    await update.message.reply_text("🚀 **Телепортация**\nВыберите город:", parse_mode='Markdown', reply_markup=markup)
 
 async def handle_city_teleport(update, context, player, text):
     if text == "⬅️ Назад":
@@ -1585,25 +2009,74 @@ async def show_stats(update, context, player):
          c_data = CLASSES.get(player.class_name)
          if c_data and 'image' in c_data: image_url = c_data['image']
 
-    await context.bot.send_photo(
+    await send_photo_cached(
+        context.bot,
         chat_id=update.effective_chat.id,
         photo=image_url,
         caption=msg,
         parse_mode='Markdown',
-        reply_markup=ReplyKeyboardMarkup([[KeyboardButton("⬅️ Назад")]], resize_keyboard=True)
+        reply_markup=BACK_KB
     )
 
+@asynccontextmanager
+async def chat_lock(chat_id):
+    """Очередь обработки одного чата: сообщения и команды не трогают игрока одновременно"""
+    entry = CHAT_LOCKS.get(chat_id)
+    if entry is None:
+        entry = CHAT_LOCKS[chat_id] = [asyncio.Lock(), 0]
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            yield
+    finally:
+        # Последний ждущий убирает блокировку: словарь не растет с числом чатов
+        entry[1] -= 1
+        if not entry[1]:
+            del CHAT_LOCKS[chat_id]
+
+def in_chat_queue(handler):
+    """Обертка для обработчиков команд: они ждут ту же очередь чата, что и сообщения"""
+    @wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        async with chat_lock(update.effective_chat.id):
+            return await handler(update, context)
+    return wrapper
+
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Откладывает сообщение на MESSAGE_DEBOUNCE: повтор того же текста в окне отменяет предыдущий"""
     if not update.message or not update.message.text:
         return
 
+    chat_id = update.effective_chat.id
+    text = update.message.text
+    pending = PENDING_MESSAGES.get(chat_id)
+    # Отбрасываем только дубль; другое нажатие ждет своей очереди в chat_lock
+    if pending and pending[0] == text and not pending[1].done():
+        pending[1].cancel()
+    task = context.application.create_task(_debounced_message(update, context, chat_id))
+    PENDING_MESSAGES[chat_id] = (text, task)
+
+async def _debounced_message(update, context, chat_id):
+    await asyncio.sleep(MESSAGE_DEBOUNCE)
+    # Окно закрыто: дальше задачу не отменяем, чтобы не оборвать обработку на середине
+    pending = PENDING_MESSAGES.get(chat_id)
+    if pending and pending[1] is asyncio.current_task():
+        del PENDING_MESSAGES[chat_id]
+    async with chat_lock(chat_id):
+        await process_message(update, context)
+
+async def process_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = update.message.text
     user_id = update.effective_user.id
-    player = get_player(user_id)
+    player = await aget_player(user_id)
 
     # Проверка на лагерь
     if player.location == "player_camp":
-        await update.message.reply_text("💤 Вы восстанавливаете силы...")
+        if time.time() - player.camp_entry_time < RESPAWN_DELAY:
+            await update.message.reply_text("💤 Вы восстанавливаете силы...")
+            return
+        # Задача возвращения потерялась (например, бот перезапускался) — выводим из лагеря сами
+        await show_location(update, context, player, player.last_location)
         return
 
     # Обработка команды сохранения
@@ -1614,39 +2087,15 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if player.location == "class_selection":
         await handle_class_selection(update, context, player, text)
         return
-    if context.user_data.get('in_battle'):
-        await handle_battle(update, context, player, text)
-        return
-    if context.user_data.get('in_story'):
-        await handle_story_action(update, context, player, text)
-        return
-    if context.user_data.get('in_random_event'):
-        await handle_random_event_action(update, context, player, text)
-        return
-    if context.user_data.get('in_city_teleport'):
-        await handle_city_teleport(update, context, player, text)
-        return
-    if context.user_data.get('in_inventory'):
-        await handle_inventory_action(update, context, player, text)
-        return
-    if context.user_data.get('in_shop') or context.user_data.get('in_shop_sell') or context.user_data.get('shop_confirm_buy') or context.user_data.get('shop_confirm_sell'):
-        await handle_shop_action(update, context, player, text)
-        return
+    user_data = context.user_data
+    for flag, handler in STATE_HANDLERS.items():
+        if user_data.get(flag):
+            await handler(update, context, player, text)
+            return
 
-    if text == "📊 Характеристики":
-        await show_player_stats(update, context, player)
-        return
-    if text == "🎒 Инвентарь":
-        await show_inventory_menu(update, context, player)
-        return
-    if text == "🚀 Телепортация":
-        await show_city_teleport_menu(update, context, player)
-        return
-    if text == "⬅️ Назад":
-        await generic_back_button(update, context, player)
-        return
-    if text == "🏠 В город":
-        await show_location(update, context, player, player.current_city)
+    handler = TEXT_HANDLERS.get(text)
+    if handler:
+        await handler(update, context, player)
         return
 
     if not await handle_location_action(update, context, player, text):
@@ -1654,6 +2103,21 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 
+# Шаблон карточки героя разбирается один раз при загрузке модуля
+STATS_TEMPLATE = (
+    "📊 **Герой** (Ур. {level})\n"
+    "❤️ Здоровье: {hp}/{max_hp}\n"
+    "⚔️ Атака: {attack}\n"
+    "🛡️ Защита: {defense}\n"
+    "💰 Золото: {gold}\n"
+    "😴 Усталость: {fatigue}%\n"
+    "📈 Опыт: {exp}/{exp_next}\n"
+    "📍 Локация: {loc_name}\n"
+    "📜 Активных квестов: {quests}\n"
+    "💾 Автосохранение: каждые 5 минут"
+)
+
+
 async def show_player_stats(update, context, player):
     """Показывает характеристики игрока с информацией о сохранении"""
     player.update_fatigue()
@@ -1665,35 +2129,31 @@ async def show_player_stats(update, context, player):
         loc_name = LOCATIONS[player.location]['name']
 
     # Основная информация
-    message = (
-        f"📊 **Герой** (Ур. {player.level})\n"
-        f"❤️ Здоровье: {stats['health']}/{player.get_max_health()}\n"
-        f"⚔️ Атака: {stats['attack']}\n"
-        f"🛡️ Защита: {stats['defense']}\n"
-        f"💰 Золото: {player.gold}\n"
-        f"😴 Усталость: {int(player.fatigue)}%\n"
-        f"📈 Опыт: {player.experience}/{player.level * 100}\n"
-        f"📍 Локация: {loc_name}\n"
-        f"📜 Активных квестов: {len(player.active_quests)}\n"
-        f"💾 Автосохранение: каждые 5 минут"
-    )
+    parts = [STATS_TEMPLATE.format(
+        level=player.level,
+        hp=stats['health'],
+        max_hp=player.get_max_health(),
+        attack=stats['attack'],
+        defense=stats['defense'],
+        gold=player.gold,
+        fatigue=int(player.fatigue),
+        exp=player.experience,
+        exp_next=player.level * 100,
+        loc_name=loc_name,
+        quests=len(player.active_quests),
+    )]
 
     # Активные эффекты
     if player.active_effects:
-        message += "\n\n🧪 **Активные эффекты:**"
-        for e in player.active_effects:
-            message += f"\n• {e['name']} ({e['duration']} ходов)"
+        parts.append("\n\n🧪 **Активные эффекты:**")
+        parts.extend(f"\n• {e['name']} ({e['duration']} ходов)" for e in player.active_effects)
 
     # Экипированные артефакты
     if player.equipped_artifacts:
-        message += "\n\n🛡️ **Экипированные артефакты:**"
-        for item_id in player.equipped_artifacts:
-            item = ITEMS.get(item_id)
-            if item:
-                message += f"\n• {item['name']}"
+        parts.append("\n\n🛡️ **Экипированные артефакты:**")
+        parts.extend(f"\n• {ITEMS[item_id]['name_md']}" for item_id in player.equipped_artifacts if item_id in ITEMS)
 
-    # Кнопка сохранения для тестирования
-    buttons = [[KeyboardButton("💾 Сохранить сейчас")], [KeyboardButton("⬅️ Назад")]]
+    message = "".join(parts)
 
     # Получаем изображение класса
     image_url = "https://i.imgur.com/3Vk5Q7a.jpeg"
@@ -1702,19 +2162,41 @@ async def show_player_stats(update, context, player):
         if c_data and 'image' in c_data:
             image_url = c_data['image']
 
-    await context.bot.send_photo(
+    await send_photo_cached(
+        context.bot,
         chat_id=update.effective_chat.id,
         photo=image_url,
         caption=message,
         parse_mode='Markdown',
-        reply_markup=ReplyKeyboardMarkup(buttons, resize_keyboard=True)
+        reply_markup=STATS_KB
     )
 
 
+async def show_current_city(update, context, player):
+    await show_location(update, context, player, player.current_city)
 
 
+# Таблицы диспетчеризации handle_message: флаг состояния проверяется по порядку,
+# фиксированные кнопки находятся одним поиском в словаре
+STATE_HANDLERS = {
+    'in_battle': handle_battle,
+    'in_story': handle_story_action,
+    'in_random_event': handle_random_event_action,
+    'in_city_teleport': handle_city_teleport,
+    'in_inventory': handle_inventory_action,
+    'in_shop': handle_shop_action,
+    'in_shop_sell': handle_shop_action,
+    'shop_confirm_buy': handle_shop_action,
+    'shop_confirm_sell': handle_shop_action,
+}
 
-
+TEXT_HANDLERS = {
+    "📊 Характеристики": show_player_stats,
+    "🎒 Инвентарь": show_inventory_menu,
+    "🚀 Телепортация": show_city_teleport_menu,
+    "⬅️ Назад": generic_back_button,
+    "🏠 В город": show_current_city,
+}
 
 
 
@@ -1733,13 +2215,16 @@ async def show_player_stats(update, context, player):
 
 async def save_player_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Команда для принудительного сохранения игрока"""
-    player = get_player(update.effective_user.id)
+    player = await aget_player(update.effective_user.id)
 
     try:
-        # Сохраняем игрока
-        success = player.save(force=True)
+        # Сохраняем игрока и дожидаемся фоновой записи, чтобы ответ был честным
+        errors_before = db.write_errors
+        await flush_player_writes(player)
+        success = await db_async.save_player(player, force=True)
+        written = await db_async.flush_writes(errors_before)
 
-        if success:
+        if success and written:
             await update.message.reply_text(
                 "💾 **Прогресс сохранен!**\n\n"
                 "Все ваши данные надежно сохранены в базе данных.",
@@ -1764,7 +2249,7 @@ class AutoSaveSystem:
 
     def __init__(self, interval=300):
         self.interval = interval
-        self.running = True
+        self._stop = threading.Event()
         self.save_thread = None
 
     def start(self):
@@ -1774,38 +2259,76 @@ class AutoSaveSystem:
         self.save_thread.start()
 
     def _save_loop(self):
-        """Цикл автосохранения"""
-        while self.running:
-            time.sleep(self.interval)
+        """Цикл автосохранения; stop() будит поток сразу, не дожидаясь конца интервала"""
+        while not self._stop.wait(self.interval):
             self.save_all_players()
 
     def save_all_players(self):
-        """Сохраняет всех игроков из кэша"""
+        """Сохраняет всех игроков из кэша одной пачкой"""
+        now = time.time()
+        rows = []
+        saved = []
+        futures = []
+        errors = 0
+
+        # Общая блокировка — только на снимок кэша; строки снимаются под блокировкой
+        # каждого игрока, так что /save одного игрока не ждет обхода всех остальных
         with SAVE_LOCK:
-            count = 0
-            errors = 0
-
-            for user_id, player in list(PLAYER_CACHE.items()):
+            snapshot = list(PLAYER_CACHE.items())
+
+        for user_id, player in snapshot:
+            # Через тот же поток БД, что и обработчики: пачки игрока не обгоняют друг друга
+            future = submit_pending(player)
+            if future is not None:
+                futures.append((user_id, future))
+            with player._save_lock:
+                # Неизмененных игроков не пишем
+                if not player._dirty:
+                    continue
                 try:
-                    if player.save():
-                        count += 1
-                    else:
-                        errors += 1
+                    row = player.to_row()
+                    player._queue_deltas()
+                    rows.append((user_id, row))
+                    saved.append(player)
+                    player._last_save = now
+                    player._dirty = False
                 except Exception as e:
                     logger.error(f"Auto-save failed for player {user_id}: {e}")
                     errors += 1
 
-            if count > 0 or errors > 0:
-                logger.info(f"💾 Auto-saved: {count} players, errors: {errors}")
+        # Ошибка одного игрока не отменяет сохранение остальных;
+        # его операции submit_pending уже вернул в _pending
+        for user_id, future in futures:
+            try:
+                future.result()
+            except Exception as e:
+                logger.error(f"Auto-save writes failed for player {user_id}: {e}")
+                errors += 1
+
+        try:
+            db.save_players(rows)
+        except Exception as e:
+            logger.error(f"Auto-save batch failed: {e}")
+            errors += len(rows)
+            rows = []
+            # Строки не записаны — пусть попадут в следующее сохранение
+            for player in saved:
+                with player._save_lock:
+                    player._dirty = True
+
+        if rows or errors:
+            logger.info(f"💾 Auto-saved: {len(rows)} players, errors: {errors}")
 
     def stop(self):
         """Останавливает автосохранение"""
-        self.running = False
+        self._stop.set()
         if self.save_thread:
-            self.save_thread.join(timeout=5)
+            # Хватает, чтобы дописать уже начатое сохранение
+            self.save_thread.join(timeout=30)
 
         # Финальное сохранение при остановке
         self.save_all_players()
+        db.flush_writes()
         logger.info("💾 All players saved on shutdown")
 
 # Создаем систему автосохранения
@@ -1839,21 +2362,42 @@ def main():
         print("ℹ️ Установите переменную окружения BOT_TOKEN")
         return
 
+    # uvloop нужно включить до того, как run_polling создаст цикл событий
+    if uvloop is not None:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        logger.info("⚡ Цикл событий: uvloop")
+
     # Запускаем систему автосохранения
     auto_save.start()
     logger.info("✅ Система автосохранения запущена")
 
     # Создаем приложение бота
-    application = Application.builder().token(TOKEN).build()
+    builder = (
+        Application.builder()
+        .token(TOKEN)
+        .request(HTTPXRequest(connection_pool_size=BOT_API_POOL_SIZE, http_version=HTTP_VERSION))
+        .get_updates_request(HTTPXRequest(http_version=HTTP_VERSION))
+    )
+    if HAS_RATE_LIMITER:
+        # Общий лимит ~30 сообщений/с и ~1/с на чат; при RetryAfter запрос повторяется
+        builder = builder.rate_limiter(AIORateLimiter(max_retries=SEND_MAX_RETRIES))
+    else:
+        logger.warning("⚠️ aiolimiter не установлен, отправка сообщений без ограничения частоты")
+    application = builder.build()
 
     # Добавляем обработчики команд
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(CommandHandler("restart", restart))
-    application.add_handler(CommandHandler("save", save_player_command))
+    # Команды идут в той же очереди чата, что и текстовые сообщения
+    application.add_handler(CommandHandler("start", in_chat_queue(start)))
+    application.add_handler(CommandHandler("restart", in_chat_queue(restart)))
+    application.add_handler(CommandHandler("save", in_chat_queue(save_player_command)))
 
     # Обработчик текстовых сообщений
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
 
+    # Частые изменения игроков сливаем в одну запись раз в AUTO_SAVE_INTERVAL_SHORT секунд
+    application.job_queue.run_repeating(flush_dirty_players, interval=AUTO_SAVE_INTERVAL_SHORT)
+    application.job_queue.run_repeating(optimize_database, interval=DB_OPTIMIZE_INTERVAL, first=DB_OPTIMIZE_INTERVAL)
+
     logger.info("✅ Бот инициализирован")
     logger.info("🤖 Ожидание сообщений...")
 
@@ -1,22 +1,273 @@
 import sqlite3
 import json
+import atexit
 import logging
 import os
+import queue
+import threading
+import time
 from datetime import datetime
 from contextlib import contextmanager
+from functools import lru_cache
 from typing import Dict, List, Optional, Any
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 logger = logging.getLogger(__name__)
 
+# effect_data читается при каждой загрузке игрока; orjson быстрее, json — запасной вариант
+if orjson is not None:
+    _json_loads = orjson.loads
+
+    def _json_dumps(obj) -> str:
+        return orjson.dumps(obj).decode('utf-8')
+else:
+    _json_loads = json.loads
+    _json_dumps = json.dumps
+
+# Очередь отложенной записи (см. queue_write)
+WRITE_QUEUE_SIZE = 10000
+WRITE_BATCH_SIZE = 256
+# Сколько ждать места в переполненной очереди, прежде чем сообщить об ошибке
+WRITE_QUEUE_TIMEOUT = 30
+# Повторы пачки при временных ошибках (например, БД занята другим процессом)
+WRITE_RETRIES = 3
+# Кэш подготовленных запросов на соединение (по умолчанию в sqlite3 — 128).
+# Кроме ~40 постоянных запросов туда попадают UPDATE из _apply_writes
+# для каждого встреченного набора полей
+STATEMENT_CACHE_SIZE = 256
+
+# Настройки, которые SQLite хранит в соединении, а не в файле БД
+CONNECTION_PRAGMAS = (
+    "PRAGMA foreign_keys = ON",
+    # В WAL fsync нужен только при checkpoint; при сбое питания теряется лишь последняя транзакция
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA cache_size = -64000",    # ~64 МБ кэша страниц
+    "PRAGMA mmap_size = 268435456",  # 256 МБ
+    "PRAGMA busy_timeout = 10000",
+)
+
+# Вся схема одним скриптом. При любом изменении SCHEMA_SQL увеличьте SCHEMA_VERSION,
+# иначе уже созданные БД (PRAGMA user_version) его не применят
+SCHEMA_VERSION = 2
+SCHEMA_SQL = """
+-- === ОСНОВНАЯ ТАБЛИЦА ИГРОКОВ ===
+CREATE TABLE IF NOT EXISTS players (
+    user_id INTEGER PRIMARY KEY,
+    username TEXT,
+    first_name TEXT,
+    last_name TEXT,
+    class_name TEXT,
+    level INTEGER DEFAULT 1,
+    experience INTEGER DEFAULT 0,
+    gold INTEGER DEFAULT 50,
+    fatigue REAL DEFAULT 100,
+    last_fatigue_update REAL,
+    artifact_slots INTEGER DEFAULT 1,
+    current_location TEXT DEFAULT 'class_selection',
+    current_city TEXT DEFAULT 'village_square',
+    last_location TEXT DEFAULT 'village_square',
+    camp_entry_time REAL DEFAULT 0,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    last_active TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- === СТАТИСТИКИ ИГРОКА ===
+CREATE TABLE IF NOT EXISTS player_stats (
+    user_id INTEGER PRIMARY KEY,
+    health INTEGER DEFAULT 100,
+    attack INTEGER DEFAULT 10,
+    defense INTEGER DEFAULT 5,
+    FOREIGN KEY (user_id) REFERENCES players (user_id) ON DELETE CASCADE
+);
+
+-- === ИНВЕНТАРЬ ===
+CREATE TABLE IF NOT EXISTS inventory (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER,
+    item_id TEXT NOT NULL,
+    quantity INTEGER DEFAULT 1,
+    equipped BOOLEAN DEFAULT FALSE,
+    acquired_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (user_id) REFERENCES players (user_id) ON DELETE CASCADE,
+    UNIQUE(user_id, item_id)
+);
+
+-- === АКТИВНЫЕ КВЕСТЫ ===
+CREATE TABLE IF NOT EXISTS active_quests (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER,
+    quest_id TEXT NOT NULL,
+    progress TEXT DEFAULT '{}',
+    started_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (user_id) REFERENCES players (user_id) ON DELETE CASCADE,
+    UNIQUE(user_id, quest_id)
+);
+
+-- === ЗАВЕРШЕННЫЕ КВЕСТЫ ===
+CREATE TABLE IF NOT EXISTS completed_quests (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER,
+    quest_id TEXT NOT NULL,
+    completed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (user_id) REFERENCES players (user_id) ON DELETE CASCADE,
+    UNIQUE(user_id, quest_id)
+);
+
+-- === АКТИВНЫЕ ЭФФЕКТЫ ===
+CREATE TABLE IF NOT EXISTS active_effects (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER,
+    effect_name TEXT NOT NULL,
+    effect_data TEXT DEFAULT '{}',
+    duration INTEGER DEFAULT 1,
+    applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (user_id) REFERENCES players (user_id) ON DELETE CASCADE
+);
+
+-- === ПРОГРЕСС СЮЖЕТА ===
+CREATE TABLE IF NOT EXISTS story_progress (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER,
+    city TEXT NOT NULL,
+    scene_id TEXT NOT NULL,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (user_id) REFERENCES players (user_id) ON DELETE CASCADE,
+    UNIQUE(user_id, city)
+);
+
+-- === ОТКРЫТЫЕ ЛОКАЦИИ ===
+CREATE TABLE IF NOT EXISTS unlocked_locations (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER,
+    location_id TEXT NOT NULL,
+    unlocked_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (user_id) REFERENCES players (user_id) ON DELETE CASCADE,
+    UNIQUE(user_id, location_id)
+);
+
+-- === ПОБЕЖДЕННЫЕ БОССЫ ===
+CREATE TABLE IF NOT EXISTS defeated_bosses (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER,
+    boss_id TEXT NOT NULL,
+    defeated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (user_id) REFERENCES players (user_id) ON DELETE CASCADE,
+    UNIQUE(user_id, boss_id)
+);
+
+-- === СЧЕТЧИК УБИЙСТВ ===
+CREATE TABLE IF NOT EXISTS kill_counts (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER,
+    enemy_id TEXT NOT NULL,
+    count INTEGER DEFAULT 0,
+    last_killed TIMESTAMP,
+    FOREIGN KEY (user_id) REFERENCES players (user_id) ON DELETE CASCADE,
+    UNIQUE(user_id, enemy_id)
+);
+
+-- === СПОСОБНОСТИ ===
+CREATE TABLE IF NOT EXISTS player_abilities (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER,
+    ability_name TEXT NOT NULL,
+    FOREIGN KEY (user_id) REFERENCES players (user_id) ON DELETE CASCADE,
+    UNIQUE(user_id, ability_name)
+);
+
+-- === КЭШ FILE_ID КАРТИНОК TELEGRAM ===
+CREATE TABLE IF NOT EXISTS photo_cache (
+    url TEXT PRIMARY KEY,
+    file_id TEXT NOT NULL
+);
+
+-- === НАЧАЛЬНЫЕ ДАННЫЕ НОВОГО ИГРОКА ===
+-- Одна вставка в players создает и остальные строки — без лишних запросов из Python
+CREATE TRIGGER IF NOT EXISTS trg_players_init
+AFTER INSERT ON players
+BEGIN
+    INSERT OR IGNORE INTO player_stats (user_id, health, attack, defense)
+    VALUES (NEW.user_id, 100, 10, 5);
+    INSERT OR IGNORE INTO unlocked_locations (user_id, location_id)
+    VALUES (NEW.user_id, 'village_square');
+END;
+
+-- === ИНДЕКСЫ ===
+CREATE INDEX IF NOT EXISTS idx_inventory_user ON inventory(user_id);
+CREATE INDEX IF NOT EXISTS idx_active_quests_user ON active_quests(user_id);
+CREATE INDEX IF NOT EXISTS idx_kill_counts_user ON kill_counts(user_id);
+-- Остальные таблицы ищутся по user_id через индексы своих UNIQUE(user_id, ...),
+-- а у эффектов уникальности нет — без индекса remove_effect читает всю таблицу
+CREATE INDEX IF NOT EXISTS idx_active_effects_user_name ON active_effects(user_id, effect_name);
+-- Надетых предметов единицы, а инвентарь может быть длинным: индекс только по ним
+CREATE INDEX IF NOT EXISTS idx_inventory_equipped ON inventory(user_id) WHERE equipped = 1;
+"""
+
+# Данные игрока из всех связанных таблиц: (таблица, a, b, c)
+_FULL_PLAYER_SQL = """
+    SELECT 'stats', health, attack, defense FROM player_stats WHERE user_id = :uid
+    UNION ALL SELECT 'inv', item_id, quantity, NULL FROM inventory WHERE user_id = :uid AND quantity > 0
+    UNION ALL SELECT 'eq', item_id, NULL, NULL FROM inventory WHERE user_id = :uid AND equipped = 1 AND quantity > 0
+    UNION ALL SELECT 'aq', quest_id, NULL, NULL FROM active_quests WHERE user_id = :uid
+    UNION ALL SELECT 'cq', quest_id, NULL, NULL FROM completed_quests WHERE user_id = :uid
+    UNION ALL SELECT 'eff', id, effect_name, duration FROM active_effects WHERE user_id = :uid
+    {effect_stats}
+    UNION ALL SELECT 'story', city, scene_id, NULL FROM story_progress WHERE user_id = :uid
+    UNION ALL SELECT 'loc', location_id, NULL, NULL FROM unlocked_locations WHERE user_id = :uid
+    UNION ALL SELECT 'boss', boss_id, NULL, NULL FROM defeated_bosses WHERE user_id = :uid
+    UNION ALL SELECT 'kill', enemy_id, count, NULL FROM kill_counts WHERE user_id = :uid
+    UNION ALL SELECT 'abil', ability_name, NULL, NULL FROM player_abilities WHERE user_id = :uid
+"""
+# Статы эффектов: с JSON1 SQLite сам разворачивает effect_data в строки (id эффекта, стат, значение),
+# без него отдаем текст и разбираем в Python
+FULL_PLAYER_SQL_JSON1 = _FULL_PLAYER_SQL.format(effect_stats="""
+    UNION ALL SELECT 'efs', e.id, j.key, j.value FROM active_effects e, json_each(e.effect_data) j
+        WHERE e.user_id = :uid AND json_valid(e.effect_data)""")
+FULL_PLAYER_SQL_TEXT = _FULL_PLAYER_SQL.format(effect_stats="""
+    UNION ALL SELECT 'efj', id, effect_data, NULL FROM active_effects WHERE user_id = :uid""")
+
+@lru_cache(maxsize=128)
+def _update_sql(table: str, keys: tuple, extra: str = '') -> str:
+    """UPDATE по набору полей; одни и те же наборы повторяются, строка собирается один раз"""
+    assignments = ', '.join(f"{k} = ?" for k in keys)
+    return f"UPDATE {table} SET {assignments}{extra} WHERE user_id = ?"
+
 class GameDatabase:
     """Класс для работы с базой данных игры"""
 
+    ALLOWED_PLAYER_FIELDS = ['class_name', 'level', 'experience', 'gold',
+                             'fatigue', 'last_fatigue_update', 'artifact_slots',
+                             'current_location', 'current_city', 'last_location',
+                             'camp_entry_time']
+    ALLOWED_STATS_FIELDS = ['health', 'attack', 'defense']
+    # Порядок значений в строке save_players (см. Player.to_row)
+    PLAYER_ROW_FIELDS = ALLOWED_PLAYER_FIELDS + ALLOWED_STATS_FIELDS
+    # Для проверки "поле разрешено" за O(1)
+    PLAYER_FIELD_SET = frozenset(ALLOWED_PLAYER_FIELDS)
+    STATS_FIELD_SET = frozenset(ALLOWED_STATS_FIELDS)
+
     def __init__(self, db_path: str = None):
         # Определяем путь к БД
         BASE_DIR = os.path.dirname(os.path.abspath(__file__))
         self.db_path = db_path or os.path.join(BASE_DIR, "game.db")
+        self._write_q = queue.Queue(maxsize=WRITE_QUEUE_SIZE)
+        self._writer = None
+        self._writer_lock = threading.Lock()
+        # Ошибки фоновой записи: счетчик и последняя ошибка (см. flush_writes)
+        self.write_errors = 0
+        self.last_write_error = None
+        # Одно соединение на поток: открываются лениво и живут до close()
+        self._local = threading.local()
+        self._conns = []
+        self._conns_lock = threading.Lock()
+        self._full_player_sql = FULL_PLAYER_SQL_JSON1
         self._ensure_data_dir()
         self.init_database()
+        atexit.register(self.close)
         logger.info(f"📁 Database initialized: {self.db_path}")
 
     def _ensure_data_dir(self):
@@ -25,180 +276,106 @@ class GameDatabase:
         if db_dir and not os.path.exists(db_dir):
             os.makedirs(db_dir, exist_ok=True)
 
-    @contextmanager
-    def get_connection(self):
-        """Контекстный менеджер для соединения с БД"""
-        conn = sqlite3.connect(self.db_path, timeout=10)
+    def _connect(self):
+        """Открывает соединение и настраивает его (выполняется один раз на поток)"""
+        # Ожидание блокировки задает busy_timeout, поэтому timeout модуля sqlite3 не нужен
+        conn = sqlite3.connect(self.db_path, timeout=0, check_same_thread=False,
+                               cached_statements=STATEMENT_CACHE_SIZE)
         conn.row_factory = sqlite3.Row
 
-        # Включаем внешние ключи
-        conn.execute("PRAGMA foreign_keys = ON")
+        for pragma in CONNECTION_PRAGMAS:
+            conn.execute(pragma)
 
+        with self._conns_lock:
+            self._conns.append(conn)
+        return conn
+
+    @contextmanager
+    def get_connection(self):
+        """Контекстный менеджер для соединения с БД.
+
+        Соединение не закрывается после каждого вызова: у каждого потока оно свое
+        и переиспользуется, поэтому кэш страниц SQLite остается прогретым.
+        Вложенные вызовы работают в одной транзакции, фиксирует ее внешний.
+        """
+        local = self._local
+        conn = getattr(local, 'conn', None)
+        if conn is None:
+            conn = local.conn = self._connect()
+            local.depth = 0
+
+        local.depth += 1
         try:
             yield conn
-            conn.commit()
+            if local.depth == 1:
+                conn.commit()
         except Exception as e:
-            conn.rollback()
-            logger.error(f"Database error: {e}")
+            if local.depth == 1:
+                conn.rollback()
+                logger.error(f"Database error: {e}")
             raise
         finally:
-            conn.close()
+            local.depth -= 1
+
+    def optimize(self):
+        """Обновляет статистику планировщика там, где она устарела (для долгоживущего процесса)"""
+        with self.get_connection() as conn:
+            conn.execute("PRAGMA optimize = 0x10002")
+
+    @contextmanager
+    def transaction(self):
+        """Объединяет несколько методов в одну транзакцию с одним коммитом:
+
+            with db.transaction():
+                db.add_abilities_bulk(...)
+                db.update_player_stats(...)
+
+        Внутри нельзя вызывать flush_writes() (а значит, complete_quest и flush_batch
+        с завершением квестов): фоновый поток записи ждал бы блокировку, которую держит
+        эта транзакция, поэтому flush_writes в этом случае сразу бросает RuntimeError.
+        """
+        with self.get_connection() as conn:
+            yield conn
+
+    def close(self):
+        """Закрывает соединения всех потоков, перед этим обновляя статистику планировщика"""
+        with self._conns_lock:
+            conns, self._conns = self._conns, []
+            # Потоки, которые обратятся к БД после close(), откроют новое соединение
+            self._local = threading.local()
+        for conn in conns:
+            try:
+                conn.execute("PRAGMA optimize")
+                conn.close()
+            except sqlite3.Error as e:
+                logger.warning(f"Failed to close database connection: {e}")
 
     def init_database(self):
         """Инициализация таблиц базы данных"""
         try:
             with self.get_connection() as conn:
-                # === ОСНОВНАЯ ТАБЛИЦА ИГРОКОВ ===
-                conn.execute("""
-                    CREATE TABLE IF NOT EXISTS players (
-                        user_id INTEGER PRIMARY KEY,
-                        username TEXT,
-                        first_name TEXT,
-                        last_name TEXT,
-                        class_name TEXT,
-                        level INTEGER DEFAULT 1,
-                        experience INTEGER DEFAULT 0,
-                        gold INTEGER DEFAULT 50,
-                        fatigue REAL DEFAULT 100,
-                        last_fatigue_update REAL,
-                        artifact_slots INTEGER DEFAULT 1,
-                        current_location TEXT DEFAULT 'class_selection',
-                        current_city TEXT DEFAULT 'village_square',
-                        last_location TEXT DEFAULT 'village_square',
-                        camp_entry_time REAL DEFAULT 0,
-                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                        last_active TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                    )
-                """)
-
-                # === СТАТИСТИКИ ИГРОКА ===
-                conn.execute("""
-                    CREATE TABLE IF NOT EXISTS player_stats (
-                        user_id INTEGER PRIMARY KEY,
-                        health INTEGER DEFAULT 100,
-                        attack INTEGER DEFAULT 10,
-                        defense INTEGER DEFAULT 5,
-                        FOREIGN KEY (user_id) REFERENCES players (user_id) ON DELETE CASCADE
-                    )
-                """)
-
-                # === ИНВЕНТАРЬ ===
-                conn.execute("""
-                    CREATE TABLE IF NOT EXISTS inventory (
-                        id INTEGER PRIMARY KEY AUTOINCREMENT,
-                        user_id INTEGER,
-                        item_id TEXT NOT NULL,
-                        quantity INTEGER DEFAULT 1,
-                        equipped BOOLEAN DEFAULT FALSE,
-                        acquired_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                        FOREIGN KEY (user_id) REFERENCES players (user_id) ON DELETE CASCADE,
-                        UNIQUE(user_id, item_id)
-                    )
-                """)
-
-                # === АКТИВНЫЕ КВЕСТЫ ===
-                conn.execute("""
-                    CREATE TABLE IF NOT EXISTS active_quests (
-                        id INTEGER PRIMARY KEY AUTOINCREMENT,
-                        user_id INTEGER,
-                        quest_id TEXT NOT NULL,
-                        progress TEXT DEFAULT '{}',
-                        started_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                        FOREIGN KEY (user_id) REFERENCES players (user_id) ON DELETE CASCADE,
-                        UNIQUE(user_id, quest_id)
-                    )
-                """)
-
-                # === ЗАВЕРШЕННЫЕ КВЕСТЫ ===
-                conn.execute("""
-                    CREATE TABLE IF NOT EXISTS completed_quests (
-                        id INTEGER PRIMARY KEY AUTOINCREMENT,
-                        user_id INTEGER,
-                        quest_id TEXT NOT NULL,
-                        completed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                        FOREIGN KEY (user_id) REFERENCES players (user_id) ON DELETE CASCADE,
-                        UNIQUE(user_id, quest_id)
-                    )
-                """)
-
-                # === АКТИВНЫЕ ЭФФЕКТЫ ===
-                conn.execute("""
-                    CREATE TABLE IF NOT EXISTS active_effects (
-                        id INTEGER PRIMARY KEY AUTOINCREMENT,
-                        user_id INTEGER,
-                        effect_name TEXT NOT NULL,
-                        effect_data TEXT DEFAULT '{}',
-                        duration INTEGER DEFAULT 1,
-                        applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                        FOREIGN KEY (user_id) REFERENCES players (user_id) ON DELETE CASCADE
-                    )
-                """)
-
-                # === ПРОГРЕСС СЮЖЕТА ===
-                conn.execute("""
-                    CREATE TABLE IF NOT EXISTS story_progress (
-                        id INTEGER PRIMARY KEY AUTOINCREMENT,
-                        user_id INTEGER,
-                        city TEXT NOT NULL,
-                        scene_id TEXT NOT NULL,
-                        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                        FOREIGN KEY (user_id) REFERENCES players (user_id) ON DELETE CASCADE,
-                        UNIQUE(user_id, city)
-                    )
-                """)
-
-                # === ОТКРЫТЫЕ ЛОКАЦИИ ===
-                conn.execute("""
-                    CREATE TABLE IF NOT EXISTS unlocked_locations (
-                        id INTEGER PRIMARY KEY AUTOINCREMENT,
-                        user_id INTEGER,
-                        location_id TEXT NOT NULL,
-                        unlocked_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                        FOREIGN KEY (user_id) REFERENCES players (user_id) ON DELETE CASCADE,
-                        UNIQUE(user_id, location_id)
-                    )
-                """)
-
-                # === ПОБЕЖДЕННЫЕ БОССЫ ===
-                conn.execute("""
-                    CREATE TABLE IF NOT EXISTS defeated_bosses (
-                        id INTEGER PRIMARY KEY AUTOINCREMENT,
-                        user_id INTEGER,
-                        boss_id TEXT NOT NULL,
-                        defeated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                        FOREIGN KEY (user_id) REFERENCES players (user_id) ON DELETE CASCADE,
-                        UNIQUE(user_id, boss_id)
-                    )
-                """)
-
-                # === СЧЕТЧИК УБИЙСТВ ===
-                conn.execute("""
-                    CREATE TABLE IF NOT EXISTS kill_counts (
-                        id INTEGER PRIMARY KEY AUTOINCREMENT,
-                        user_id INTEGER,
-                        enemy_id TEXT NOT NULL,
-                        count INTEGER DEFAULT 0,
-                        last_killed TIMESTAMP,
-                        FOREIGN KEY (user_id) REFERENCES players (user_id) ON DELETE CASCADE,
-                        UNIQUE(user_id, enemy_id)
-                    )
-                """)
-
-                # === СПОСОБНОСТИ ===
-                conn.execute("""
-                    CREATE TABLE IF NOT EXISTS player_abilities (
-                        id INTEGER PRIMARY KEY AUTOINCREMENT,
-                        user_id INTEGER,
-                        ability_name TEXT NOT NULL,
-                        FOREIGN KEY (user_id) REFERENCES players (user_id) ON DELETE CASCADE,
-                        UNIQUE(user_id, ability_name)
-                    )
-                """)
-
-                # === ИНДЕКСЫ ===
-                conn.execute("CREATE INDEX IF NOT EXISTS idx_inventory_user ON inventory(user_id)")
-                conn.execute("CREATE INDEX IF NOT EXISTS idx_active_quests_user ON active_quests(user_id)")
-                conn.execute("CREATE INDEX IF NOT EXISTS idx_kill_counts_user ON kill_counts(user_id)")
+                # WAL сохраняется в самом файле БД: читатели не ждут писателей,
+                # а запись не делает fsync на каждый коммит
+                conn.execute("PRAGMA journal_mode = WAL")
+
+                # Схема уже в актуальной версии — DDL на теплой БД не выполняем
+                if conn.execute("PRAGMA user_version").fetchone()[0] != SCHEMA_VERSION:
+                    conn.executescript(SCHEMA_SQL)
+                    conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+                # Первый запуск: собираем статистику, чтобы планировщик сразу знал об индексах
+                has_stats = conn.execute(
+                    "SELECT 1 FROM sqlite_master WHERE name = 'sqlite_stat1'"
+                ).fetchone()
+                if not has_stats:
+                    conn.execute("ANALYZE")
+
+                # JSON1 встроен в SQLite с 3.38; в старых сборках его может не быть
+                try:
+                    conn.execute("SELECT json_valid('{}')")
+                except sqlite3.OperationalError:
+                    logger.warning("SQLite JSON1 is unavailable, effects are decoded in Python")
+                    self._full_player_sql = FULL_PLAYER_SQL_TEXT
 
             logger.info("✅ Database tables created successfully")
 
@@ -206,6 +383,245 @@ class GameDatabase:
             logger.error(f"❌ Failed to initialize database: {e}")
             raise
 
+    # ==================== ОТЛОЖЕННАЯ ЗАПИСЬ ====================
+
+    def queue_write(self, kind: str, user_id: int, payload):
+        """Ставит запись в очередь фонового потока и сразу возвращает управление.
+
+        kind: 'player' / 'stats' — словарь полей (повторные обновления схлопываются,
+        побеждает последнее значение); 'rows' — список (user_id, строка PLAYER_ROW_FIELDS),
+        user_id не используется; 'quests' / 'abilities' / 'locations' — список id.
+        """
+        self._ensure_writer()
+        try:
+            self._write_q.put_nowait((kind, user_id, payload))
+        except queue.Full:
+            # Писатель не успевает — ждем места. Писать самим нельзя: запись обогнала бы
+            # более старые из очереди, и писатель потом затер бы ее устаревшими данными.
+            # queue.Full по истечении WRITE_QUEUE_TIMEOUT получает вызывающий
+            logger.warning("Write queue is full, waiting for the writer")
+            self._write_q.put((kind, user_id, payload), timeout=WRITE_QUEUE_TIMEOUT)
+
+    def save_players(self, rows: List[tuple]):
+        """Сохраняет игроков пачкой: rows — список (user_id, строка PLAYER_ROW_FIELDS).
+
+        Вся пачка уходит в очередь одним элементом и пишется фоновым потоком
+        в одной транзакции (executemany по players и player_stats).
+        """
+        if rows:
+            self.queue_write('rows', None, rows)
+
+    def flush_writes(self, errors_before: Optional[int] = None) -> bool:
+        """Дожидается, пока фоновый поток запишет все поставленные в очередь изменения.
+
+        Возвращает False, если за время ожидания какая-то запись не удалась
+        (подробности — в last_write_error). errors_before — значение write_errors,
+        снятое до постановки своих записей: тогда учитываются и ошибки, случившиеся
+        раньше вызова flush_writes.
+        """
+        if errors_before is None:
+            errors_before = self.write_errors
+        if self._writer is None:
+            return self.write_errors == errors_before
+        # Внутри открытой транзакции ожидание не закончится никогда: фоновому потоку
+        # нужна блокировка записи, которую держит вызывающий
+        if getattr(self._local, 'depth', 0) > 0:
+            raise RuntimeError("flush_writes() called inside a transaction would deadlock the writer thread")
+        self._write_q.join()
+        return self.write_errors == errors_before
+
+    def _ensure_writer(self):
+        if self._writer is not None:
+            return
+        with self._writer_lock:
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._writer_loop, name="db-writer", daemon=True)
+                self._writer.start()
+
+    def _writer_loop(self):
+        """Забирает из очереди до WRITE_BATCH_SIZE записей и пишет их одной транзакцией"""
+        while True:
+            batch = [self._write_q.get()]
+            try:
+                while len(batch) < WRITE_BATCH_SIZE:
+                    batch.append(self._write_q.get_nowait())
+            except queue.Empty:
+                pass
+
+            try:
+                self._write_batch(batch)
+            finally:
+                for _ in batch:
+                    self._write_q.task_done()
+
+    def _write_batch(self, batch):
+        """Пишет пачку, повторяя при ошибке; порядок записей не меняется"""
+        for attempt in range(WRITE_RETRIES):
+            try:
+                self._apply_writes(batch)
+                return
+            except Exception as e:
+                logger.warning(f"Background write failed ({len(batch)} ops, attempt {attempt + 1}): {e}")
+                time.sleep(0.5 * (attempt + 1))
+
+        # Ошибка не проходит — пишем по одной записи, чтобы потерять только сбойную
+        for op in batch:
+            try:
+                self._apply_writes([op])
+            except Exception as e:
+                self.write_errors += 1
+                self.last_write_error = e
+                logger.error(f"Background write dropped ({op[0]}, user {op[1]}): {e}")
+
+    def _apply_writes(self, batch):
+        players = {}
+        stats = {}
+        rows = {'quests': set(), 'abilities': set(), 'locations': set()}
+
+        # Схлопываем повторные обновления одного игрока
+        for kind, user_id, payload in batch:
+            if kind == 'player':
+                players.setdefault(user_id, {}).update(payload)
+            elif kind == 'stats':
+                stats.setdefault(user_id, {}).update(payload)
+            elif kind == 'rows':
+                n = len(self.ALLOWED_PLAYER_FIELDS)
+                for row_user_id, row in payload:
+                    players.setdefault(row_user_id, {}).update(zip(self.ALLOWED_PLAYER_FIELDS, row[:n]))
+                    stats.setdefault(row_user_id, {}).update(zip(self.ALLOWED_STATS_FIELDS, row[n:]))
+            else:
+                rows[kind].update((user_id, value) for value in payload)
+
+        with self.get_connection() as conn:
+            for table, extra, allowed, updates in (
+                ('players', ', last_active = CURRENT_TIMESTAMP', self.PLAYER_FIELD_SET, players),
+                ('player_stats', '', self.STATS_FIELD_SET, stats),
+            ):
+                # Игроков с одинаковым набором полей пишем одним executemany
+                groups = {}
+                for user_id, fields in updates.items():
+                    keys = tuple(k for k in fields if k in allowed)
+                    if keys:
+                        groups.setdefault(keys, []).append([fields[k] for k in keys] + [user_id])
+                for keys, params in groups.items():
+                    conn.executemany(_update_sql(table, keys, extra), params)
+
+            if rows['quests']:
+                conn.executemany(
+                    "INSERT OR IGNORE INTO active_quests (user_id, quest_id) VALUES (?, ?)",
+                    list(rows['quests'])
+                )
+            if rows['abilities']:
+                conn.executemany(
+                    "INSERT OR IGNORE INTO player_abilities (user_id, ability_name) VALUES (?, ?)",
+                    list(rows['abilities'])
+                )
+            if rows['locations']:
+                conn.executemany(
+                    "INSERT OR IGNORE INTO unlocked_locations (user_id, location_id) VALUES (?, ?)",
+                    list(rows['locations'])
+                )
+
+    def flush_batch(self, user_id: int, ops: List[tuple]):
+        """Выполняет накопленные за игровое действие операции одной транзакцией.
+
+        ops — список (kind, *payload):
+        ('item', item_id, quantity), ('kill', enemy_id), ('ability', name),
+        ('quest_done', quest_id), ('boss', boss_id), ('story', city, scene_id),
+        ('effect', name, stats, duration), ('effect_end', name),
+        ('equip', item_id), ('unequip', item_id)
+
+        Эффекты и экипировка применяются после предметов и в порядке ops
+        (надел и тут же снял — в БД останется снятым).
+        """
+        if not ops:
+            return
+
+        items = {}
+        kills = {}
+        abilities = []
+        quests_done = []
+        bosses = []
+        story = []
+        ordered = []
+        for kind, *payload in ops:
+            if kind == 'item':
+                items[payload[0]] = items.get(payload[0], 0) + payload[1]
+            elif kind == 'kill':
+                kills[payload[0]] = kills.get(payload[0], 0) + 1
+            elif kind == 'ability':
+                abilities.append((user_id, payload[0]))
+            elif kind == 'quest_done':
+                quests_done.append((user_id, payload[0]))
+            elif kind == 'boss':
+                bosses.append((user_id, payload[0]))
+            elif kind == 'story':
+                story.append((user_id, payload[0], payload[1]))
+            elif kind == 'effect':
+                ordered.append((
+                    "INSERT INTO active_effects (user_id, effect_name, effect_data, duration) VALUES (?, ?, ?, ?)",
+                    (user_id, payload[0], _json_dumps(payload[1]), payload[2])
+                ))
+            elif kind == 'effect_end':
+                ordered.append((
+                    "DELETE FROM active_effects WHERE user_id = ? AND effect_name = ?",
+                    (user_id, payload[0])
+                ))
+            elif kind in ('equip', 'unequip'):
+                ordered.append((
+                    "UPDATE inventory SET equipped = ? WHERE user_id = ? AND item_id = ?",
+                    (kind == 'equip', user_id, payload[0])
+                ))
+
+        if quests_done:
+            # Отложенная вставка в active_quests не должна вернуть завершенный квест
+            self.flush_writes()
+
+        with self.get_connection() as conn:
+            if items:
+                conn.executemany("""
+                    INSERT INTO inventory (user_id, item_id, quantity) VALUES (?, ?, ?)
+                    ON CONFLICT(user_id, item_id) DO UPDATE SET quantity = quantity + excluded.quantity
+                """, [(user_id, item_id, qty) for item_id, qty in items.items()])
+                if any(qty <= 0 for qty in items.values()):
+                    conn.execute(
+                        "DELETE FROM inventory WHERE user_id = ? AND quantity <= 0",
+                        (user_id,)
+                    )
+            for sql, params in ordered:
+                conn.execute(sql, params)
+            if kills:
+                conn.executemany("""
+                    INSERT INTO kill_counts (user_id, enemy_id, count, last_killed)
+                    VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+                    ON CONFLICT(user_id, enemy_id) DO UPDATE
+                    SET count = count + excluded.count, last_killed = CURRENT_TIMESTAMP
+                """, [(user_id, enemy_id, n) for enemy_id, n in kills.items()])
+            if abilities:
+                conn.executemany(
+                    "INSERT OR IGNORE INTO player_abilities (user_id, ability_name) VALUES (?, ?)",
+                    abilities
+                )
+            if quests_done:
+                conn.executemany(
+                    "DELETE FROM active_quests WHERE user_id = ? AND quest_id = ?",
+                    quests_done
+                )
+                conn.executemany(
+                    "INSERT OR IGNORE INTO completed_quests (user_id, quest_id) VALUES (?, ?)",
+                    quests_done
+                )
+            if bosses:
+                conn.executemany(
+                    "INSERT OR IGNORE INTO defeated_bosses (user_id, boss_id) VALUES (?, ?)",
+                    bosses
+                )
+            if story:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO story_progress (user_id, city, scene_id) VALUES (?, ?, ?)",
+                    story
+                )
+
     # ==================== МЕТОДЫ ДЛЯ ИГРОКОВ ====================
 
     def create_player(self, user_id: int, username: str = None,
@@ -214,19 +630,10 @@ class GameDatabase:
         with self.get_connection() as conn:
             conn.execute("""
                 INSERT OR IGNORE INTO players
-                (user_id, username, first_name, last_name)
-                VALUES (?, ?, ?, ?)
-            """, (user_id, username, first_name, last_name))
-
-            conn.execute("""
-                INSERT OR IGNORE INTO player_stats (user_id, health, attack, defense)
-                VALUES (?, 100, 10, 5)
-            """, (user_id,))
-
-            conn.execute("""
-                INSERT OR IGNORE INTO unlocked_locations (user_id, location_id)
-                VALUES (?, 'village_square')
-            """, (user_id,))
+                (user_id, username, first_name, last_name, last_fatigue_update)
+                VALUES (?, ?, ?, ?, ?)
+            """, (user_id, username, first_name, last_name, time.time()))
+            # Статистика и стартовая локация добавляются триггером trg_players_init
 
     def get_player(self, user_id: int) -> Optional[Dict]:
         """Получает основные данные игрока"""
@@ -243,99 +650,62 @@ class GameDatabase:
 
     def get_full_player_data(self, user_id: int) -> Optional[Dict]:
         """Получает ВСЕ данные игрока"""
+        # Отложенные записи должны попасть в БД до чтения
+        self.flush_writes()
+
         with self.get_connection() as conn:
             player = self.get_player(user_id)
             if not player:
                 return None
 
-            # Статистика
-            stats_row = conn.execute(
-                "SELECT health, attack, defense FROM player_stats WHERE user_id = ?",
-                (user_id,)
-            ).fetchone()
-            if stats_row:
-                player['stats'] = dict(stats_row)
-
-            # Инвентарь
-            inventory_rows = conn.execute("""
-                SELECT item_id, quantity, equipped
-                FROM inventory
-                WHERE user_id = ? AND quantity > 0
-            """, (user_id,)).fetchall()
-
-            player['inventory'] = []
+            player['inventory'] = {}
             player['equipped_items'] = []
-            for row in inventory_rows:
-                # Добавляем предмет quantity раз в инвентарь
-                for _ in range(row['quantity']):
-                    player['inventory'].append(row['item_id'])
-                if row['equipped']:
-                    player['equipped_items'].append(row['item_id'])
-
-            # Квесты
-            active_rows = conn.execute(
-                "SELECT quest_id FROM active_quests WHERE user_id = ?",
-                (user_id,)
-            ).fetchall()
-            player['active_quests'] = [row['quest_id'] for row in active_rows]
-
-            completed_rows = conn.execute(
-                "SELECT quest_id FROM completed_quests WHERE user_id = ?",
-                (user_id,)
-            ).fetchall()
-            player['completed_quests'] = [row['quest_id'] for row in completed_rows]
-
-            # Эффекты
-            effects_rows = conn.execute("""
-                SELECT effect_name, effect_data, duration
-                FROM active_effects
-                WHERE user_id = ?
-            """, (user_id,)).fetchall()
-
-            player['active_effects'] = []
-            for row in effects_rows:
-                effect = {
-                    'name': row['effect_name'],
-                    'stats': json.loads(row['effect_data']) if row['effect_data'] else {},
-                    'duration': row['duration']
-                }
-                player['active_effects'].append(effect)
-
-            # Сюжет
-            story_rows = conn.execute(
-                "SELECT city, scene_id FROM story_progress WHERE user_id = ?",
-                (user_id,)
-            ).fetchall()
-            player['story_progress'] = {row['city']: row['scene_id'] for row in story_rows}
-
-            # Локации
-            location_rows = conn.execute(
-                "SELECT location_id FROM unlocked_locations WHERE user_id = ?",
-                (user_id,)
-            ).fetchall()
-            player['unlocked_locations'] = [row['location_id'] for row in location_rows]
-
-            # Боссы
-            boss_rows = conn.execute(
-                "SELECT boss_id FROM defeated_bosses WHERE user_id = ?",
-                (user_id,)
-            ).fetchall()
-            player['defeated_bosses'] = [row['boss_id'] for row in boss_rows]
-
-            # Убийства
-            kill_rows = conn.execute(
-                "SELECT enemy_id, count FROM kill_counts WHERE user_id = ?",
-                (user_id,)
-            ).fetchall()
-            player['kill_count'] = {row['enemy_id']: row['count'] for row in kill_rows}
-
-            # Способности
-            ability_rows = conn.execute(
-                "SELECT ability_name FROM player_abilities WHERE user_id = ?",
-                (user_id,)
-            ).fetchall()
-            player['abilities'] = [row['ability_name'] for row in ability_rows]
-
+            player['active_quests'] = []
+            player['completed_quests'] = []
+            # UNION ALL не гарантирует порядок строк: эффект собирается из 'eff' и 'efs'/'efj'
+            # в любом порядке, а список строится по id уже после чтения
+            effects = {}
+            player['story_progress'] = {}
+            player['unlocked_locations'] = []
+            player['defeated_bosses'] = []
+            player['kill_count'] = {}
+            player['abilities'] = []
+
+            # Все связанные таблицы одним запросом; k — из какой таблицы строка.
+            # Строки распаковываются по позиции, поэтому обертки sqlite3.Row не нужны
+            cur = conn.cursor()
+            cur.row_factory = None
+            for k, a, b, c in cur.execute(self._full_player_sql, {'uid': user_id}):
+                if k == 'inv':
+                    player['inventory'][a] = b
+                elif k == 'eq':
+                    player['equipped_items'].append(a)
+                elif k == 'stats':
+                    player['stats'] = {'health': a, 'attack': b, 'defense': c}
+                elif k == 'aq':
+                    player['active_quests'].append(a)
+                elif k == 'cq':
+                    player['completed_quests'].append(a)
+                elif k == 'eff':
+                    effect = effects.setdefault(a, {'name': None, 'stats': {}, 'duration': 0})
+                    effect['name'] = b
+                    effect['duration'] = c
+                elif k == 'efs':
+                    effects.setdefault(a, {'name': None, 'stats': {}, 'duration': 0})['stats'][b] = c
+                elif k == 'efj':
+                    effects.setdefault(a, {'name': None, 'stats': {}, 'duration': 0})['stats'] = _json_loads(b) if b else {}
+                elif k == 'story':
+                    player['story_progress'][a] = b
+                elif k == 'loc':
+                    player['unlocked_locations'].append(a)
+                elif k == 'boss':
+                    player['defeated_bosses'].append(a)
+                elif k == 'kill':
+                    player['kill_count'][a] = b
+                elif k == 'abil':
+                    player['abilities'].append(a)
+
+            player['active_effects'] = [effects[effect_id] for effect_id in sorted(effects)]
             return player
 
     def update_player(self, user_id: int, **kwargs):
@@ -343,24 +713,22 @@ class GameDatabase:
         if not kwargs:
             return
 
-        with self.get_connection() as conn:
-            fields = []
-            values = []
-
-            allowed_fields = ['class_name', 'level', 'experience', 'gold',
-                             'fatigue', 'last_fatigue_update', 'artifact_slots',
-                             'current_location', 'current_city', 'last_location',
-                             'camp_entry_time']
+        keys = tuple(k for k in kwargs if k in self.PLAYER_FIELD_SET)
+        if not keys:
+            return
 
-            for key, value in kwargs.items():
-                if key in allowed_fields:
-                    fields.append(f"{key} = ?")
-                    values.append(value)
+        with self.get_connection() as conn:
+            conn.execute(
+                _update_sql('players', keys, ', last_active = CURRENT_TIMESTAMP'),
+                [kwargs[k] for k in keys] + [user_id]
+            )
 
-            if fields:
-                values.append(user_id)
-                query = f"UPDATE players SET {', '.join(fields)}, last_active = CURRENT_TIMESTAMP WHERE user_id = ?"
-                conn.execute(query, values)
+    def init_class(self, user_id: int, ability_names: List[str],
+                   health: int, attack: int, defense: int):
+        """Стартовые способности и характеристики выбранного класса одной транзакцией"""
+        with self.transaction():
+            self.add_abilities_bulk(user_id, ability_names)
+            self.update_player_stats(user_id, health, attack, defense)
 
     def update_player_stats(self, user_id: int, health: int = None,
                            attack: int = None, defense: int = None):
@@ -389,46 +757,29 @@ class GameDatabase:
     def add_item(self, user_id: int, item_id: str, quantity: int = 1):
         """Добавляет предмет в инвентарь"""
         with self.get_connection() as conn:
-            existing = conn.execute(
-                "SELECT quantity FROM inventory WHERE user_id = ? AND item_id = ?",
-                (user_id, item_id)
-            ).fetchone()
-
-            if existing:
-                new_quantity = existing['quantity'] + quantity
-                conn.execute("""
-                    UPDATE inventory SET quantity = ?
-                    WHERE user_id = ? AND item_id = ?
-                """, (new_quantity, user_id, item_id))
-            else:
-                conn.execute("""
-                    INSERT INTO inventory (user_id, item_id, quantity)
-                    VALUES (?, ?, ?)
-                """, (user_id, item_id, quantity))
+            conn.execute("""
+                INSERT INTO inventory (user_id, item_id, quantity)
+                VALUES (?, ?, ?)
+                ON CONFLICT(user_id, item_id) DO UPDATE SET quantity = quantity + excluded.quantity
+            """, (user_id, item_id, quantity))
 
     def remove_item(self, user_id: int, item_id: str, quantity: int = 1):
         """Удаляет предмет из инвентаря"""
         with self.get_connection() as conn:
-            existing = conn.execute(
-                "SELECT quantity FROM inventory WHERE user_id = ? AND item_id = ?",
-                (user_id, item_id)
-            ).fetchone()
+            row = conn.execute("""
+                UPDATE inventory SET quantity = quantity - ?
+                WHERE user_id = ? AND item_id = ? AND quantity > 0
+                RETURNING quantity
+            """, (quantity, user_id, item_id)).fetchone()
 
-            if not existing:
+            if not row:
                 return False
 
-            new_quantity = existing['quantity'] - quantity
-
-            if new_quantity <= 0:
+            if row[0] <= 0:
                 conn.execute(
                     "DELETE FROM inventory WHERE user_id = ? AND item_id = ?",
                     (user_id, item_id)
                 )
-            else:
-                conn.execute("""
-                    UPDATE inventory SET quantity = ?
-                    WHERE user_id = ? AND item_id = ?
-                """, (new_quantity, user_id, item_id))
 
             return True
 
@@ -458,8 +809,21 @@ class GameDatabase:
                 VALUES (?, ?)
             """, (user_id, quest_id))
 
+    def start_quests_bulk(self, user_id: int, quest_ids: List[str]):
+        """Начинает несколько квестов одним запросом"""
+        if not quest_ids:
+            return
+        with self.get_connection() as conn:
+            conn.executemany("""
+                INSERT OR IGNORE INTO active_quests (user_id, quest_id)
+                VALUES (?, ?)
+            """, [(user_id, quest_id) for quest_id in quest_ids])
+
     def complete_quest(self, user_id: int, quest_id: str):
         """Завершает квест"""
+        # Иначе отложенная вставка в active_quests может вернуть квест после удаления
+        self.flush_writes()
+
         with self.get_connection() as conn:
             conn.execute(
                 "DELETE FROM active_quests WHERE user_id = ? AND quest_id = ?",
@@ -476,23 +840,12 @@ class GameDatabase:
     def add_kill(self, user_id: int, enemy_id: str):
         """Добавляет убийство врага"""
         with self.get_connection() as conn:
-            existing = conn.execute(
-                "SELECT count FROM kill_counts WHERE user_id = ? AND enemy_id = ?",
-                (user_id, enemy_id)
-            ).fetchone()
-
-            if existing:
-                new_count = existing['count'] + 1
-                conn.execute("""
-                    UPDATE kill_counts
-                    SET count = ?, last_killed = CURRENT_TIMESTAMP
-                    WHERE user_id = ? AND enemy_id = ?
-                """, (new_count, user_id, enemy_id))
-            else:
-                conn.execute("""
-                    INSERT INTO kill_counts (user_id, enemy_id, count, last_killed)
-                    VALUES (?, ?, 1, CURRENT_TIMESTAMP)
-                """, (user_id, enemy_id))
+            conn.execute("""
+                INSERT INTO kill_counts (user_id, enemy_id, count, last_killed)
+                VALUES (?, ?, 1, CURRENT_TIMESTAMP)
+                ON CONFLICT(user_id, enemy_id) DO UPDATE
+                SET count = count + 1, last_killed = CURRENT_TIMESTAMP
+            """, (user_id, enemy_id))
 
     def add_defeated_boss(self, user_id: int, boss_id: str):
         """Добавляет победу над боссом"""
@@ -512,6 +865,16 @@ class GameDatabase:
                 VALUES (?, ?)
             """, (user_id, ability_name))
 
+    def add_abilities_bulk(self, user_id: int, ability_names: List[str]):
+        """Добавляет несколько способностей одним запросом"""
+        if not ability_names:
+            return
+        with self.get_connection() as conn:
+            conn.executemany("""
+                INSERT OR IGNORE INTO player_abilities (user_id, ability_name)
+                VALUES (?, ?)
+            """, [(user_id, ability_name) for ability_name in ability_names])
+
     # ==================== ЭФФЕКТЫ ====================
 
     def add_effect(self, user_id: int, effect_name: str, effect_data: Dict, duration: int):
@@ -520,7 +883,7 @@ class GameDatabase:
             conn.execute("""
                 INSERT INTO active_effects (user_id, effect_name, effect_data, duration)
                 VALUES (?, ?, ?, ?)
-            """, (user_id, effect_name, json.dumps(effect_data), duration))
+            """, (user_id, effect_name, _json_dumps(effect_data), duration))
 
     def remove_effect(self, user_id: int, effect_name: str):
         """Удаляет эффект"""
@@ -530,6 +893,16 @@ class GameDatabase:
                 WHERE user_id = ? AND effect_name = ?
             """, (user_id, effect_name))
 
+    def remove_effects_bulk(self, user_id: int, effect_names: List[str]):
+        """Удаляет несколько эффектов одним запросом"""
+        if not effect_names:
+            return
+        with self.get_connection() as conn:
+            conn.executemany("""
+                DELETE FROM active_effects
+                WHERE user_id = ? AND effect_name = ?
+            """, [(user_id, effect_name) for effect_name in effect_names])
+
     # ==================== СЮЖЕТ И ЛОКАЦИИ ====================
 
     def update_story_progress(self, user_id: int, city: str, scene_id: str):
@@ -548,5 +921,33 @@ class GameDatabase:
                 VALUES (?, ?)
             """, (user_id, location_id))
 
+    def unlock_locations_bulk(self, user_id: int, location_ids: List[str]):
+        """Открывает несколько локаций одним запросом"""
+        if not location_ids:
+            return
+        with self.get_connection() as conn:
+            conn.executemany("""
+                INSERT OR IGNORE INTO unlocked_locations (user_id, location_id)
+                VALUES (?, ?)
+            """, [(user_id, location_id) for location_id in location_ids])
+
+    # ==================== КЭШ КАРТИНОК ====================
+
+    def get_photo_file_ids(self) -> Dict[str, str]:
+        """Возвращает сохраненные file_id картинок: url -> file_id"""
+        with self.get_connection() as conn:
+            return dict(conn.execute("SELECT url, file_id FROM photo_cache").fetchall())
+
+    def save_photo_file_id(self, url: str, file_id: Optional[str]):
+        """Запоминает file_id картинки; None удаляет запись"""
+        with self.get_connection() as conn:
+            if file_id is None:
+                conn.execute("DELETE FROM photo_cache WHERE url = ?", (url,))
+            else:
+                conn.execute(
+                    "INSERT OR REPLACE INTO photo_cache (url, file_id) VALUES (?, ?)",
+                    (url, file_id)
+                )
+
 # Глобальный экземпляр базы данных
 db = GameDatabase()
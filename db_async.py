@@ -0,0 +1,59 @@
+import asyncio
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import partial
+
+from database import db
+
+# Асинхронные обертки над синхронными методами GameDatabase.
+# sqlite блокирует поток, поэтому из обработчиков бота вызовы уходят
+# в отдельный поток БД, а цикл событий продолжает обслуживать других игроков.
+# Поток один: у него одно долгоживущее соединение (см. GameDatabase.get_connection),
+# а операции выполняются в том порядке, в каком их отправили обработчики.
+DB_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db")
+
+def submit(func, *args, **kwargs):
+    """Ставит вызов в поток БД после уже отправленных; для потоков вне цикла событий"""
+    try:
+        return DB_EXECUTOR.submit(func, *args, **kwargs)
+    except RuntimeError:
+        # Пул уже остановлен (выход интерпретатора) — выполняем в текущем потоке
+        future = Future()
+        try:
+            future.set_result(func(*args, **kwargs))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+async def _run(func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(DB_EXECUTOR, partial(func, *args, **kwargs))
+
+async def get_full_player_data(user_id: int):
+    return await _run(db.get_full_player_data, user_id)
+
+async def create_player(user_id: int):
+    return await _run(db.create_player, user_id)
+
+async def init_class(user_id: int, ability_names, health: int, attack: int, defense: int):
+    return await _run(db.init_class, user_id, list(ability_names), health, attack, defense)
+
+async def start_quest(user_id: int, quest_id: str):
+    return await _run(db.start_quest, user_id, quest_id)
+
+async def save_player(player, force: bool = False):
+    """Сохраняет игрока в потоке БД; возвращает результат Player.save"""
+    return await _run(player.save, force=force)
+
+async def sync_player(player):
+    """Перечитывает игрока из БД в потоке БД (см. Player.sync_from_db)"""
+    return await _run(player.sync_from_db)
+
+async def flush_writes(errors_before=None):
+    """Дожидается фоновой очереди записи, не блокируя цикл событий; False — была ошибка записи"""
+    return await _run(db.flush_writes, errors_before)
+
+async def optimize():
+    return await _run(db.optimize)
+
+async def save_photo_file_id(url: str, file_id):
+    return await _run(db.save_photo_file_id, url, file_id)
@@ -0,0 +1,162 @@
+"""Сквозные проверки пути сохранения: создание -> сохранение -> вытеснение -> загрузка.
+
+Запуск из корня репозитория: python -m unittest discover tests
+"""
+import asyncio
+import os
+import sys
+import tempfile
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault("BOT_TOKEN", "123:test")
+
+import database  # noqa: E402
+import db_async  # noqa: E402
+import bot  # noqa: E402
+
+
+class PersistenceTestCase(unittest.TestCase):
+    """Каждый тест работает со своей временной БД и пустым кэшем игроков"""
+
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.db = database.GameDatabase(os.path.join(self._tmp.name, "game.db"))
+        for module in (database, db_async, bot):
+            patcher = mock.patch.object(module, "db", self.db)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        bot.PLAYER_CACHE.clear()
+        self.addCleanup(bot.PLAYER_CACHE.clear)
+
+    def tearDown(self):
+        self.wait_for_db()
+        self.db.close()
+        self._tmp.cleanup()
+
+    def wait_for_db(self):
+        """Дожидается потока БД и фоновой очереди записи"""
+        db_async.submit(lambda: None).result()
+        self.db.flush_writes()
+
+    def evict(self, user_id):
+        """Вытесняет игрока из кэша так же, как _cache_player при переполнении"""
+        bot.PLAYER_CACHE.move_to_end(user_id, last=False)
+        newest = bot.PLAYER_CACHE[next(reversed(bot.PLAYER_CACHE))]
+        with mock.patch.object(bot, "MAX_CACHED_PLAYERS", len(bot.PLAYER_CACHE) - 1):
+            bot._cache_player(newest)
+        self.assertNotIn(user_id, bot.PLAYER_CACHE)
+        self.wait_for_db()
+
+
+class RoundTripTest(PersistenceTestCase):
+    def test_new_player_survives_eviction(self):
+        player = asyncio.run(bot.aget_player(1))
+        self.assertTrue(player._dirty)
+        asyncio.run(bot.aget_player(2))
+        bot.auto_save.save_all_players()
+        self.evict(1)
+
+        reloaded = asyncio.run(bot.aget_player(1))
+        self.assertIsNotNone(reloaded.last_fatigue_update)
+        reloaded.update_fatigue()
+        self.assertEqual(reloaded.location, "class_selection")
+
+    def test_state_round_trip(self):
+        artifact = next(i for i, item in bot.ITEMS.items() if item.get("type") == "artifact")
+        city = next(loc for loc in bot.LOCATIONS if loc != "village_square")
+
+        player = asyncio.run(bot.aget_player(1))
+        player.gold = 321
+        player.add_item("health_potion", 3)
+        player.remove_item("health_potion")
+        player.add_item(artifact)
+        self.assertTrue(player.equip_artifact(artifact)[0])
+        player.add_effect("buff", {"attack": 2}, 2)
+        player.unlock_city(city)
+        player.defer_write("kill", "wolf")
+        asyncio.run(bot.aget_player(2))
+        self.evict(1)
+
+        reloaded = asyncio.run(bot.aget_player(1))
+        self.assertIsNot(reloaded, player)
+        self.assertEqual(reloaded.gold, 321)
+        self.assertEqual(reloaded.inventory["health_potion"], 2)
+        self.assertEqual(reloaded.equipped_artifacts, {artifact})
+        self.assertEqual(reloaded.active_effects, [{"name": "buff", "stats": {"attack": 2}, "duration": 2}])
+        self.assertTrue(reloaded.has_location(city))
+        self.assertEqual(reloaded.kill_count, {"wolf": 1})
+
+    def test_failed_flush_keeps_ops_in_order(self):
+        player = asyncio.run(bot.aget_player(1))
+        self.wait_for_db()
+        player.add_item("health_potion", 1)
+        with mock.patch.object(self.db, "flush_batch", side_effect=RuntimeError("disk")):
+            with self.assertRaises(RuntimeError):
+                asyncio.run(bot.flush_player_writes(player))
+        self.assertEqual(player._pending, [("item", "health_potion", 1)])
+
+        player.add_item("health_potion", 1)
+        asyncio.run(bot.flush_player_writes(player))
+        self.assertEqual(player._pending, [])
+        self.assertEqual(self.db.get_full_player_data(1)["inventory"], {"health_potion": 2})
+
+
+class FlushBatchTest(PersistenceTestCase):
+    def setUp(self):
+        super().setUp()
+        self.db.create_player(1)
+
+    def test_zero_quantity_row_is_deleted(self):
+        self.db.flush_batch(1, [("item", "health_potion", 1), ("item", "health_potion", -1)])
+        self.assertEqual(self.db.get_full_player_data(1)["inventory"], {})
+
+    def test_ordered_ops_apply_in_sequence(self):
+        self.db.flush_batch(1, [
+            ("item", "sword", 1),
+            ("equip", "sword"), ("unequip", "sword"),
+            ("effect", "buff", {"attack": 1}, 1), ("effect_end", "buff"),
+        ])
+        data = self.db.get_full_player_data(1)
+        self.assertEqual(data["equipped_items"], [])
+        self.assertEqual(data["active_effects"], [])
+
+    def test_quest_done_inside_transaction_raises(self):
+        self.db.start_quest(1, "first_steps")
+        self.db.queue_write("quests", 1, ["other"])
+        with self.assertRaises(RuntimeError):
+            with self.db.transaction():
+                self.db.flush_batch(1, [("quest_done", "first_steps")])
+        self.db.flush_batch(1, [("quest_done", "first_steps")])
+        self.assertEqual(self.db.get_full_player_data(1)["completed_quests"], ["first_steps"])
+
+
+class DebounceTest(unittest.TestCase):
+    def test_only_repeated_text_is_dropped(self):
+        handled = []
+
+        async def process_message(update, context):
+            handled.append(update.message.text)
+
+        def make_update(text):
+            return SimpleNamespace(message=SimpleNamespace(text=text), effective_chat=SimpleNamespace(id=1))
+
+        async def run():
+            loop = asyncio.get_running_loop()
+            context = SimpleNamespace(application=SimpleNamespace(create_task=loop.create_task))
+            for text in ("attack", "attack", "potion"):
+                await bot.handle_message(make_update(text), context)
+            await asyncio.sleep(bot.MESSAGE_DEBOUNCE * 4)
+
+        with mock.patch.object(bot, "process_message", process_message):
+            asyncio.run(run())
+        self.assertEqual(handled, ["attack", "potion"])
+        self.assertEqual(bot.CHAT_LOCKS, {})
+        self.assertEqual(bot.PENDING_MESSAGES, {})
+
+
+if __name__ == "__main__":
+    unittest.main()